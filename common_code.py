@@ -1,24 +1,122 @@
+import os
+import re
+import json
+import time
+import queue
+import fnmatch
+import hashlib
+import sqlite3
+import itertools
+import threading
+import concurrent.futures
+
+
+# path -> ((inode, mtime, size), dict) of the json files read through read_json_file_dict
+_json_cache = dict()
+_temp_counter = itertools.count()
+
+# Directories listed at once by scan_file_types, listing is mostly waiting on the file server
+SCAN_WORKERS = 16
+# Where FileIndex keeps its databases, one per indexed directory
+FILE_INDEX_DIR = os.path.join(os.path.expanduser("~"), ".cache", "file_index")
+
+
+def encode_json(json_as_dict, compact=False):
+    '''
+    Returns the json text of the dict: indented with sorted keys for people to read, or as small and quick to
+    write as possible if compact, for files only machines read.
+    '''
+    if compact:
+        return json.dumps(json_as_dict, separators=(",", ":"))
+    return json.dumps(json_as_dict, indent=4, sort_keys=True)
 
-def read_json_file_dict(json_path):
+
+def write_file_atomic(path, text):
+    '''
+    Writes the text to a temporary file next to path, syncs it to disk and renames it over path, so readers only
+    ever see the old or the new file whole, even if this process dies half way.
+    The file keeps its permissions if it already existed.
+    '''
+    dir_path = os.path.dirname(os.path.abspath(path))
+    temp_path = os.path.join(dir_path, ".{}.{}.{}.tmp".format(os.path.basename(path), os.getpid(), next(_temp_counter)))
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with os.fdopen(fd, "w") as temp_file:
+            temp_file.write(text)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        try:
+            os.chmod(temp_path, os.stat(path).st_mode & 0o7777)
+        except FileNotFoundError:
+            pass
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+    _json_cache.pop(os.path.abspath(path), None)
+
+    # Make the rename itself durable
+    try:
+        dir_fd = os.open(dir_path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+
+def read_json_file_dict(json_path, cached=False):
     '''
     Reads the json file and returns the dict
+
+    With cached, the file is only parsed again once it changed, until then a read costs one stat and returns the
+    same dict as the previous read, shared by every cached reader, so it must not be modified. Copying it would
+    cost more than parsing, so callers that modify what they read leave cached off and get a dict of their own.
     '''
+    cache_key = os.path.abspath(json_path)
+    if cached:
+        stat = os.stat(json_path)
+        # A rename over the file changes the inode, an edit in place the mtime or the size
+        signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        entry = _json_cache.get(cache_key)
+        if entry is not None and entry[0] == signature:
+            return entry[1]
+
     with open(json_path, "r") as loaded_json_file:
+        if cached:
+            # Stat what is actually read, the file may have been replaced since
+            stat = os.fstat(loaded_json_file.fileno())
+            signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
         try:
             json_as_dict = json.load(loaded_json_file)
         except ValueError:
             json_as_dict = {}
+    if cached:
+        _json_cache[cache_key] = (signature, json_as_dict)
     return json_as_dict
 
 
-def save_json_file(loaded_json_file, json_as_dict):
+def save_json_file(loaded_json_file, json_as_dict, compact=False):
     '''
     Save the master log file, overwriting the previous master log with the new data.
+
+    The file is rewritten in place, as other processes wait on the lock of this very file. The data is encoded
+    before the file is touched, so an unserializable value leaves the old contents intact.
     '''
     try:
+        text = encode_json(json_as_dict, compact)
         loaded_json_file.seek(0)
         loaded_json_file.truncate()
-        json.dump(json_as_dict, loaded_json_file, indent=4, sort_keys=True)
+        loaded_json_file.write(text)
+        loaded_json_file.flush()
+        os.fsync(loaded_json_file.fileno())
+        _json_cache.pop(os.path.abspath(loaded_json_file.name), None)
     except Exception as e:
         print(e)
         print("Error: Failure to save new master log file.")
@@ -49,55 +147,389 @@ def create_directory(dir_path):
 
 
 
+class UniqueNameAllocator(object):
+    '''
+    Hands out file names no one else has, adding _1, _2 and so on before the extension when a name is taken.
+
+    A name is reserved by creating it empty with O_CREAT|O_EXCL, so two callers never get the same one, not even
+    from different processes. The next suffix to try is remembered per name, and found the first time by
+    probing suffixes 1, 2, 4, 8... then bisecting back to the first free one, so even with 100k taken names
+    only a few dozen stats are needed and the directory is never listed.
+    '''
+
+    def __init__(self):
+        # (path without extension, extension) -> next suffix to try
+        self._next_suffix = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _create(path):
+        try:
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666))
+        except FileExistsError:
+            return False
+        return True
+
+    @staticmethod
+    def _first_free_suffix(fn, fext, start):
+        # Galloping search, assuming the taken suffixes from start on are mostly contiguous
+        taken = lambda n: os.path.lexists("{}_{}{}".format(fn, n, fext))
+        if not taken(start):
+            return start
+        step = 1
+        low = start
+        while taken(start + step):
+            low = start + step
+            step *= 2
+        high = start + step
+        # low is taken and high is free, bisect for the first free one in between
+        while high - low > 1:
+            middle = (low + high) // 2
+            if taken(middle):
+                low = middle
+            else:
+                high = middle
+        return high
+
+    def reserve(self, filename, count=1):
+        '''
+        Reserve count available names for filename and return them, filename itself first if it is free.
+        '''
+        names = list()
+        if self._create(filename):
+            names.append(filename)
+            if count == 1:
+                return names
+        fn, fext = os.path.splitext(filename)
+        key = (fn, fext)
+        with self._lock:
+            suffix = self._next_suffix.get(key)
+            if suffix is None:
+                suffix = self._first_free_suffix(fn, fext, 1)
+            while len(names) < count:
+                name = "{}_{}{}".format(fn, suffix, fext)
+                if self._create(name):
+                    names.append(name)
+                    suffix += 1
+                else:
+                    # Taken by someone else since, skip past what they took
+                    suffix = self._first_free_suffix(fn, fext, suffix + 1)
+            self._next_suffix[key] = suffix
+        return names
+
+    def allocate(self, filename):
+        '''
+        Reserve and return filename if it is free, otherwise the next available name with a suffix.
+        '''
+        return self.reserve(filename)[0]
+
+
 def file_exists_check(filename):
     '''
     Checks if the file already exists and returns a new filename if there exists one already with an '_1', '_2' and so on.
+    Nothing is created, so another caller may take the name first; use UniqueNameAllocator to reserve it.
 
     @filename	: full path of the file to be checked
     @returns	: full file path that is available
     '''
     new_filename = filename
     if os.path.exists(filename):
-        fpath = os.path.dirname(filename)	#full directory path of the file
-        fn = os.path.splitext(filename)[0]	#obtain only the file path without the extension
-        fext = os.path.splitext(filename)[1]	#obtain the file extension
-        all_files_prefixed = [file for file in os.listdir(fpath) if file.startswith(os.path.splitext(os.path.basename(fn))[0]) and file.endswith(fext)]	#obtain all filenames that are prefixed with the same filename
-        new_filename = fn + "_" + str(len(all_files_prefixed)) + fext	#new file name will be +1 of the file extension
-        if os.path.exists(new_filename):
-            new_filename = fn + "_" + str(int(time.time())) + fext
+        fn, fext = os.path.splitext(filename)	#file path without the extension, and the extension
+        suffix = UniqueNameAllocator._first_free_suffix(fn, fext, 1)
+        new_filename = fn + "_" + str(suffix) + fext
 
         # print('Image file already exists, creating a new one - ' + new_filename)
 
     return new_filename
 
-def search_recursive_file_type(root_dir, extensions, max_depth=10, relative=False):
-    """
-    Retrun the first file found recursively within directory matching requested file type(s)
-    """
-    results = list()
-    for root, dirnames, filenames in os.walk(os.path.realpath(root_dir)):
-        # Clear the current directory list if we have already reached the max recursion depth
-        if root.count(os.sep) >= (max_depth + root_dir.count(os.sep)):
-            del dirnames[:]
-        # search filenames in this dir/subdir for appropriate file extensions
-        for ext in extensions:
-            # note that the fnmatch.filter function uses wildcards but not regex
-            for filename in fnmatch.filter(filenames, '*' + ext):
-                # return because we want just one match per directory, don't care which of the matches if multiple
-                results.append(os.path.join(root, filename))
-    if relative:
-        for i, path in enumerate(results):
-            results[i] = path.replace(root_dir, "")
-
-    return results
-
-
-def dict_to_json_file(data_dict, saveas_path):
+
+def extension_matcher(extensions):
+    '''
+    Returns a function telling if a file name ends with any of the extensions, which may hold fnmatch wildcards.
+    All of them are matched at once by one compiled expression.
+    '''
+    pattern = "|".join(fnmatch.translate("*" + os.path.normcase(ext)) for ext in extensions)
+    if not pattern:
+        return lambda name: False
+    match = re.compile(pattern).match
+    return lambda name: match(os.path.normcase(name)) is not None
+
+
+def scan_file_types(root_dir, extensions, max_depth=10, relative=False, first_per_directory=False, limit=None,
+                    workers=SCAN_WORKERS):
+    '''
+    Yields the files within directory matching requested file type(s), as they are found.
+
+    Directories are listed concurrently on a pool of threads, so the order is not defined. Stop early by passing a
+    limit, or by not consuming the rest: closing the generator stops the scan. first_per_directory yields just one
+    match per directory, whichever is seen first. Directories deeper than max_depth below root_dir are not
+    listed and symbolic links to directories are not followed. Paths are absolute under the real path of
+    root_dir, or relative to it.
+    '''
+    root = os.path.realpath(root_dir)
+    matches_name = extension_matcher(extensions)
+    # One (matches, number of subdirectories queued) item per directory listed
+    listed = queue.Queue()
+    stop = threading.Event()
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    def list_directory(dir_path, depth):
+        matches = list()
+        subdirs = list()
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    if stop.is_set():
+                        break
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    if is_dir:
+                        if depth < max_depth and not entry.is_symlink():
+                            subdirs.append(entry.path)
+                    elif (not first_per_directory or not matches) and matches_name(entry.name):
+                        matches.append(entry.path)
+        except OSError:
+            # Unreadable directories are skipped, as os.walk does
+            pass
+        finally:
+            # Counted before they are queued, so the scan cannot look finished while they are still to report
+            listed.put((matches, len(subdirs)))
+        for subdir in subdirs:
+            try:
+                pool.submit(list_directory, subdir, depth + 1)
+            except RuntimeError:
+                # The scan was stopped and the pool shut down
+                break
+
+    found = 0
+    try:
+        pool.submit(list_directory, root, 0)
+        outstanding = 1
+        while outstanding:
+            matches, queued = listed.get()
+            outstanding += queued - 1
+            for path in matches:
+                yield os.path.relpath(path, root) if relative else path
+                found += 1
+                if limit is not None and found >= limit:
+                    return
+    finally:
+        stop.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def search_recursive_file_type(root_dir, extensions, max_depth=10, relative=False, first_per_directory=False):
+    '''
+    Return all files found recursively within directory matching requested file type(s), sorted.
+    Only the first match of each directory with first_per_directory. See scan_file_types to stream them instead.
+    '''
+    return sorted(scan_file_types(root_dir, extensions, max_depth, relative, first_per_directory))
+
+
+class FileIndex(object):
+    '''
+    Persistent index of the files below a directory, for searching the same trees again and again.
+
+    The path, size and mtime of every file are kept in an sqlite database, by default one per root in
+    FILE_INDEX_DIR. A refresh stats every known directory and lists again only those whose mtime changed, which
+    is when files were added, removed or renamed in them; a file rewritten in place keeps its indexed size and
+    mtime until then. Queries refresh first if the last refresh, by any process, is older than max_age seconds,
+    or always if max_age is None.
+
+        index = FileIndex("/results/run_12")
+        odb_paths = index.find([".odb"])
+        index.close()
+    '''
+
+    # A directory changed this recently may change again within the same mtime, it is listed again next refresh
+    RACY_SECONDS = 2.0
+
+    def __init__(self, root_dir, index_path=None, max_depth=10, max_age=60.0, workers=SCAN_WORKERS):
+        self.root = os.path.realpath(root_dir)
+        if index_path is None:
+            create_directory(FILE_INDEX_DIR)
+            root_hash = hashlib.sha1(self.root.encode("utf-8", "surrogateescape")).hexdigest()
+            index_path = os.path.join(FILE_INDEX_DIR, root_hash + ".sqlite")
+        self.index_path = index_path
+        self.max_depth = max_depth
+        self.max_age = max_age
+        self.workers = workers
+
+        self.connection = sqlite3.connect(index_path, timeout=60)
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+            CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, parent TEXT, depth INTEGER, mtime_ns INTEGER);
+            CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent);
+            CREATE TABLE IF NOT EXISTS files (
+                dir TEXT, name TEXT, ext TEXT, size INTEGER, mtime_ns INTEGER, PRIMARY KEY (dir, name));
+            CREATE INDEX IF NOT EXISTS files_ext ON files (ext);
+            """)
+        stored = dict(self.connection.execute("SELECT key, value FROM meta"))
+        if stored.get("root", self.root) != self.root or stored.get("max_depth", max_depth) != max_depth:
+            # Indexed differently, start over
+            self.connection.executescript("DELETE FROM meta; DELETE FROM dirs; DELETE FROM files;")
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO meta VALUES (?, ?)", [("root", self.root), ("max_depth", max_depth)])
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def _list_directory(self, rel_dir, known_mtime_ns):
+        # Runs on the pool: ("gone", ...), ("same", ...) or ("listed", ..., files, subdirectory names)
+        dir_path = os.path.join(self.root, rel_dir) if rel_dir else self.root
+        try:
+            mtime_ns = os.stat(dir_path).st_mtime_ns
+        except OSError:
+            return "gone", rel_dir, None, None, None
+        if mtime_ns == known_mtime_ns:
+            return "same", rel_dir, mtime_ns, None, None
+
+        files = list()
+        subdirs = list()
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    if is_dir:
+                        if not entry.is_symlink():
+                            subdirs.append(entry.name)
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        # Broken symbolic link
+                        stat = entry.stat(follow_symlinks=False)
+                    files.append((rel_dir, entry.name, os.path.splitext(entry.name)[1], stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            # Unreadable, indexed as empty until a later refresh can list it
+            mtime_ns = None
+        if mtime_ns is not None and time.time() - mtime_ns / 1e9 < self.RACY_SECONDS:
+            mtime_ns = None
+        return "listed", rel_dir, mtime_ns, files, subdirs
+
+    def _forget(self, rel_dir):
+        if not rel_dir:
+            self.connection.executescript("DELETE FROM dirs; DELETE FROM files;")
+            return
+        # Drop a directory and everything below it, "a/" <= path < "a0" being exactly the paths below "a"
+        below = (rel_dir + os.sep, rel_dir + chr(ord(os.sep) + 1))
+        self.connection.execute("DELETE FROM dirs WHERE path = ? OR (path >= ? AND path < ?)", (rel_dir,) + below)
+        self.connection.execute("DELETE FROM files WHERE dir = ? OR (dir >= ? AND dir < ?)", (rel_dir,) + below)
+
+    def refresh(self):
+        '''
+        Brings the index up to date with the tree, listing only the directories that changed.
+        Returns the number of directories listed and found unchanged.
+        '''
+        known = {path: (depth, mtime_ns) for path, depth, mtime_ns in
+                 self.connection.execute("SELECT path, depth, mtime_ns FROM dirs")}
+        counts = {"listed": 0, "unchanged": 0}
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            with self.connection:
+                pending = {pool.submit(self._list_directory, "", known.get("", (0, None))[1]): 0}
+                while pending:
+                    done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        depth = pending.pop(future)
+                        state, rel_dir, mtime_ns, files, subdirs = future.result()
+                        if state == "gone":
+                            self._forget(rel_dir)
+                            continue
+
+                        children = [path for path, in self.connection.execute(
+                            "SELECT path FROM dirs WHERE parent = ?", (rel_dir,))]
+                        if state == "same":
+                            counts["unchanged"] += 1
+                        else:
+                            counts["listed"] += 1
+                            self.connection.execute(
+                                "INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?)",
+                                (rel_dir, os.path.dirname(rel_dir) if rel_dir else None, depth, mtime_ns))
+                            self.connection.execute("DELETE FROM files WHERE dir = ?", (rel_dir,))
+                            self.connection.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?)", files)
+                            listed_children = [os.path.join(rel_dir, name) for name in subdirs]
+                            for child in set(children) - set(listed_children):
+                                self._forget(child)
+                            children = listed_children
+
+                        if depth < self.max_depth:
+                            for child in children:
+                                future = pool.submit(self._list_directory, child, known.get(child, (0, None))[1])
+                                pending[future] = depth + 1
+                self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('refreshed', ?)", (time.time(),))
+        finally:
+            pool.shutdown(cancel_futures=True)
+        return counts
+
+    def _refresh_if_old(self):
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'refreshed'").fetchone()
+        if row is None or self.max_age is None or time.time() - row[0] > self.max_age:
+            self.refresh()
+
+    def _rows(self, patterns):
+        # Rows that may match, narrowed by the extension index when every pattern ends in a plain extension
+        extensions = set()
+        for pattern in patterns:
+            ext = os.path.splitext(pattern)[1]
+            if not ext or any(c in ext for c in "*?["):
+                return self.connection.execute("SELECT dir, name FROM files")
+            extensions.add(ext)
+        marks = ", ".join("?" * len(extensions))
+        return self.connection.execute("SELECT dir, name FROM files WHERE ext IN ({})".format(marks), sorted(extensions))
+
+    def find(self, extensions, relative=False, first_per_directory=False):
+        '''
+        Return all indexed files matching requested file type(s), sorted, as search_recursive_file_type does.
+        '''
+        self._refresh_if_old()
+        matches_name = extension_matcher(extensions)
+        results = list()
+        seen_dirs = set()
+        for rel_dir, name in self._rows(["*" + ext for ext in extensions]):
+            if not matches_name(name):
+                continue
+            if first_per_directory:
+                if rel_dir in seen_dirs:
+                    continue
+                seen_dirs.add(rel_dir)
+            rel_path = os.path.join(rel_dir, name)
+            results.append(rel_path if relative else os.path.join(self.root, rel_path))
+        return sorted(results)
+
+    def glob(self, pattern, relative=False):
+        '''
+        Return the indexed files whose path relative to the root matches the fnmatch pattern, sorted.
+        As with fnmatch, * also matches across directories.
+        '''
+        self._refresh_if_old()
+        match = re.compile(fnmatch.translate(os.path.normcase(pattern))).match
+        results = list()
+        for rel_dir, name in self._rows([pattern]):
+            rel_path = os.path.join(rel_dir, name)
+            if match(os.path.normcase(rel_path)):
+                results.append(rel_path if relative else os.path.join(self.root, rel_path))
+        return sorted(results)
+
+
+def dict_to_json_file(data_dict, saveas_path, compact=False):
     '''
-    Saves the given dict as a json file
+    Saves the given dict as a json file, atomically. compact drops the indentation, for files only machines read.
     '''
-    with open(saveas_path, 'w') as file_dump:
-        json.dump(data_dict, file_dump, indent=4, sort_keys=True)
+    write_file_atomic(saveas_path, encode_json(data_dict, compact))
 
     return 0
 
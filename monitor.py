@@ -15,28 +15,72 @@ Enjoy!
 
 class Monitor: Contains task objects. Monitors and runs the associated commands.
 class Task: Contains info about a script to be executed and its status
+class RetryPolicy: When and how soon a failed Task is run again.
+class LoadThrottle: Paces the launches of a Monitor by the measured load and free memory of the machine.
+class CallableTask: A Task that calls a python function on the monitor's pool of worker processes.
+class MapTask: A Task that runs a function or command on every item of a list found at runtime, in adaptive batches.
+class AsyncMonitor: A Monitor to be awaited from inside an asyncio event loop.
+class AsyncTask: A Task launched and awaited with asyncio subprocesses, for use with AsyncMonitor.
+class StatusRenderer: Draws the status table of a Monitor in the terminal.
+class LocalExecutor: Runs task commands on this machine. The default executor of a Monitor.
+class AttachedProcess: Process handle for a task process started by an earlier monitor that is still running.
+class OutputCapture: Reads the output of local task commands through pipes into size capped, rotated log files.
+class RemoteExecutor: Hands task commands to worker agents on other machines (see run_worker).
 
 The purpose of the monitor and task classes is to be able to define a scripted workflow that can be automated and
 also has the ability to be interrupted and resumed.
 """
 
 import os
+import re
 import sys
+import asyncio
+import shutil
+import hashlib
+import gzip
+import socket
+import tempfile
+import argparse
+import concurrent.futures
+import multiprocessing
+import itertools
+import functools
+import contextlib
+import traceback
+import collections
 import time
+import signal
+import select
+import selectors
+import threading
 import subprocess
 import datetime
 import json
+import pickle
+import heapq
+import random
 
-# If launched as a standalone script, we still want ability to reference the daass package
-daass_path = os.path.abspath(__file__)
-while not os.path.basename(daass_path) == "daass":
-    daass_path = os.path.dirname(daass_path)
-ansa_auto_path = os.path.dirname(daass_path)
-sys.path.append(ansa_auto_path)
+try:
+    import fcntl
+except ImportError:
+    # Not available on windows, journal appends are then unlocked
+    fcntl = None
 
-DEBUG_TASK_KEY = "DEBUG"
+# Commands that only need to log import the light monitor_client instead of this module
+try:
+    from . import monitor_client
+except ImportError:
+    import monitor_client
 
-from daass.shared import file_utils
+DEBUG_TASK_KEY = monitor_client.DEBUG_TASK_KEY
+
+
+def _file_utils():
+    """
+    daass.shared.file_utils, imported on first use so that importing this module does not need the daass package.
+    If launched as a standalone script, we still want ability to reference the daass package.
+    """
+    return monitor_client.import_file_utils(__file__)
 
 
 class Monitor(object):
@@ -48,35 +92,126 @@ class Monitor(object):
     HEADER = "STATUS      TASK                            Result/Info"
     TEMPLATE = "{:12}{:32}{}"
     # This is not really a rate, but an inverse rate. This is the sleep time.
+    # When waiting on child process events, this is only the fallback heartbeat.
     REFRESH_RATE = 5
+    # Minimum seconds between two saves of the json log by the writer thread
+    FLUSH_INTERVAL = 1
 
     # The environment variable name for the log path
-    LOG_DUMP = "MONITOR_LOG_DUMP_PATH"
-    LOG_JSON = "MONITOR_LOG_JSON_PATH"
+    LOG_DUMP = monitor_client.LOG_DUMP
+    LOG_JSON = monitor_client.LOG_JSON
+    LOG_JOURNAL = monitor_client.LOG_JOURNAL
+    LOG_SOCKET = monitor_client.LOG_SOCKET
+    # Larger messages than this go to the journal, a datagram is sent whole or not at all
+    LOG_DATAGRAM_MAX = monitor_client.LOG_DATAGRAM_MAX
 
     # Logging dict keys
-    _KEY_LOG = "info_log"
+    _KEY_LOG = monitor_client.KEY_LOG
     _KEY_CMD = "command"
-    _KEY_MESSAGE = "message"
-    _KEY_TIMESTAMP = "timestamp"
+    _KEY_MESSAGE = monitor_client.KEY_MESSAGE
+    _KEY_TIMESTAMP = monitor_client.KEY_TIMESTAMP
     _KEY_STATUS = "status"
-
-    def __init__(self, workflow_name, logging_dir, refresh_timestamp=None):
+    _KEY_TASK = monitor_client.KEY_TASK
+    _KEY_DURATION = "duration"
+    _KEY_DURATION_HISTORY = "durations"
+    _KEY_METRICS = "metrics"
+    _KEY_PROCESS = "process"
+
+    # Assumed runtime in seconds of a task that has never completed, when no other task has either
+    DEFAULT_DURATION = 1.0
+    # Runtimes kept per task for its median
+    DURATION_HISTORY = 9
+
+    # A speculative task still running after this many times its median runtime gets a duplicate, if there is capacity
+    SPECULATIVE_FACTOR = 2.0
+
+    # Lines in a task's stderr matching any of these regular expressions mark the task as failed
+    ERROR_PATTERNS = ("Error:",)
+    # Bytes read at a time when scanning stderr for errors
+    ERROR_SCAN_CHUNK = 1 << 20
+
+    # Cached outputs are copied in and out of the cache. Set True to hard link them when possible instead, which is
+    # fast but shares one file between the cache and every restored copy: linked files are made read-only, so a
+    # tool writing into one in place fails rather than corrupting the others, and tasks must replace their outputs.
+    CACHE_LINK = False
+
+    # check_if_done_fn and check_if_skip_fn run on a thread pool of this size so that a slow check does not stall
+    # the monitor. A check running longer than CHECK_TIMEOUT seconds is reported and its result treated as False.
+    # A result is reused until the task's status or process state changes, or it is CHECK_MEMO_TTL seconds old.
+    CHECK_WORKERS = 8
+    CHECK_TIMEOUT = 60
+    CHECK_MEMO_TTL = REFRESH_RATE
+
+    # Worker processes for CallableTask, started on the first call and kept for the whole run. None for one per cpu.
+    CALL_WORKERS = None
+
+    # Minimum seconds between two saves of the workflow metrics file
+    METRICS_INTERVAL = 5
+
+    def __init__(self, workflow_name, logging_dir, refresh_timestamp=None, event_driven=True, max_parallel=None, resources=None,
+                 error_patterns=None, executor=None, cache_dir=None, metrics_format="json", output_capture=None, throttle=None):
         self.name = workflow_name
         self.refresh_timestamp = refresh_timestamp
+        # If event driven, the main loop wakes as soon as any child process exits (SIGCHLD)
+        # rather than only every REFRESH_RATE seconds
+        self.event_driven = event_driven
+
+        # Ready tasks are only launched while there is capacity for them.
+        # max_parallel limits the number of running tasks, None means no limit.
+        # resources is the total capacity per named resource, for example {"cpu": 16, "mem_gb": 64, "licence": 2},
+        # which tasks claim with their own resources dict. Resources not named here are unlimited.
+        self.max_parallel = max_parallel
+        self.resource_capacity = dict(resources or {})
+        self._resources_in_use = dict()
+        self._resource_claims = dict()
+
+        # Task graph, built once by build_task_graph when the monitor starts.
+        # Tasks are pushed to the ready queue when their count of unmet prerequisites reaches zero,
+        # and popped in order of longest remaining critical path.
+        self._dependents = None
+        self._cancel_dependents = None
+        self._unmet_prereq_counts = None
+        self._priorities = None
+        self._topo_order = None
+        self._ready_queue = list()
+        # Failed tasks waiting out their retry backoff, as (time due, index)
+        self._retry_queue = list()
 
         # This is the log where all prints go for general debugging needs
         # This is for developer use only (but could potentially be used for error detection)
         self.log_dump_dir = os.path.join(logging_dir, "task_logs")
         self.log_testing = os.path.join(logging_dir, "error_summary.txt")
-        file_utils.create_directory(self.log_dump_dir)
+        # Error patterns are compiled once. Patterns may be strings or compiled expressions, which are kept as they
+        # are so their flags still apply.
+        if error_patterns is None:
+            error_patterns = self.ERROR_PATTERNS
+        self.error_regexes = [
+            re.compile(pattern) if isinstance(pattern, str) else pattern for pattern in error_patterns
+        ]
+        _file_utils().create_directory(self.log_dump_dir)
         # This is a clean json formatted log for showing status to the user
         # This is for user's gui info and no debugging stuff belongs here
-        self.log_json_path = os.path.join(logging_dir, file_utils.clean_filename(workflow_name) + ".json")
+        self.log_json_path = os.path.join(logging_dir, _file_utils().clean_filename(workflow_name) + ".json")
+        # Messages are appended here as one json record per line by subprocesses,
+        # the monitor reads them incrementally and saves them into the json log
+        self.log_journal_path = os.path.join(logging_dir, _file_utils().clean_filename(workflow_name) + ".journal")
+        # While the monitor runs, subprocesses send their messages as datagrams to this socket instead,
+        # and only use the journal if the monitor is not listening or is not keeping up
+        self.log_socket_path = os.path.join(logging_dir, _file_utils().clean_filename(workflow_name) + ".sock")
+
+        # Workflow level metrics, rewritten while the workflow runs. metrics_format is "json", "prometheus" or None for none.
+        self.metrics_format = metrics_format
+        metrics_extension = ".prom" if metrics_format == "prometheus" else ".metrics.json"
+        self.metrics_path = os.path.join(logging_dir, _file_utils().clean_filename(workflow_name) + metrics_extension)
+        self.started_time = None
+        self._metrics_written_time = 0
+        # Counters of the monitor's own overhead: ticks, cpu spent per tick, json log bytes written and read
+        self.stats = collections.Counter()
 
         # This is setting the log path variable for all python subprocesses launched by this monitor
         # This is to be used by the class method log_string
         os.environ[self.LOG_JSON] = self.log_json_path
+        os.environ[self.LOG_JOURNAL] = self.log_journal_path
 
         self.tasks = list()
         self.active_task_indexs = set()
@@ -84,16 +219,540 @@ class Monitor(object):
         self.failed_task_indexs = set()
 
         self.cursor = None
+        self.renderer = StatusRenderer(self)
+
+        # Opt in result cache. Tasks that declare inputs and outputs are skipped when the same command was already
+        # run on the same input contents, by this or any other workflow using the same cache_dir.
+        self.cache_dir = cache_dir
+        # (path, size, mtime) -> sha256 of the file contents, so unchanged inputs are only hashed once
+        self._file_digests = dict()
+
+        self.check_pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.CHECK_WORKERS, thread_name_prefix="monitor-check")
+        self.call_pool = None
+
+        # The executor decides where task commands run, on this machine by default
+        if executor is None:
+            executor = LocalExecutor()
+        self.executor = executor
+        # If given an OutputCapture, local commands write through pipes to rotated logs, and the last lines are kept
+        self.output_capture = output_capture
+        # If given a LoadThrottle, tasks are launched only as fast as the machine absorbs them
+        self.throttle = throttle
+        self._throttled = False
+
+        # The authoritative log state, only the writer thread saves it to the json log
+        self.log_dict = dict()
+        self._log_lock = threading.RLock()
+        self._log_dirty = False
+        # Task name -> (entry, its json text) as last saved
+        self._encoded_entries = dict()
+        self._journal_offset = 0
+        self._flush_event = threading.Event()
+        self._log_writer_stop = threading.Event()
+        self._log_writer = None
+        self._log_socket = None
+        self._log_receiver = None
+        self._log_receiver_stop = threading.Event()
+
+        # Wakeup pipe and selector used to wait on child process events
+        self._selector = None
+        self._wakeup_r = None
+        self._wakeup_w = None
+        self._old_sigchld = None
+        self._old_wakeup_fd = None
 
     def add_task(self, task):
         next_index = len(self.tasks)
         self.tasks.append(task)
+        self.renderer.task_changed(next_index)
         return next_index
 
+    def expected_durations(self):
+        """
+        Expected runtime of each task, by index, from its last successful run if known,
+        otherwise the average of the tasks that have one.
+        """
+        with self._log_lock:
+            durations = {
+                name: entry[self._KEY_DURATION] for name, entry in self.log_dict.items()
+                if isinstance(entry, dict) and self._KEY_DURATION in entry
+            }
+        if durations:
+            default = sum(durations.values()) / len(durations)
+        else:
+            default = self.DEFAULT_DURATION
+        return [durations.get(task.name, default) for task in self.tasks]
+
+    def critical_path_lengths(self, durations):
+        """
+        For each task, by index, the time from its start to the end of its longest chain of dependents.
+        """
+        lengths = [0.0] * len(self.tasks)
+        for index in reversed(self._topo_order):
+            downstream = max((lengths[i] for i in self._dependents[index]), default=0.0)
+            lengths[index] = durations[index] + downstream
+        return lengths
+
+    def record_duration(self, task, seconds):
+        with self._log_lock:
+            entry = self.log_dict[task.name]
+            entry[self._KEY_DURATION] = seconds
+            history = entry.get(self._KEY_DURATION_HISTORY, list()) + [seconds]
+            entry[self._KEY_DURATION_HISTORY] = history[-self.DURATION_HISTORY:]
+            self._log_dirty = True
+        self._flush_event.set()
+
+    def median_duration(self, task):
+        """
+        Median runtime of the task's recent successful runs, or None if it has never completed.
+        """
+        with self._log_lock:
+            entry = self.log_dict.get(task.name, {})
+            history = entry.get(self._KEY_DURATION_HISTORY)
+            if not history and self._KEY_DURATION in entry:
+                history = [entry[self._KEY_DURATION]]
+        if not history:
+            return None
+        history = sorted(history)
+        middle = len(history) // 2
+        if len(history) % 2:
+            return history[middle]
+        return (history[middle - 1] + history[middle]) / 2
+
+    def record_process(self, task, process_info):
+        """
+        Save what is needed to find a launched process again if the monitor is restarted while it runs.
+        """
+        with self._log_lock:
+            self.log_dict[task.name][self._KEY_PROCESS] = process_info
+            self._log_dirty = True
+        self._flush_event.set()
+
+    def saved_process(self, task):
+        with self._log_lock:
+            return self.log_dict.get(task.name, {}).get(self._KEY_PROCESS)
+
+    def record_metrics(self, task, metrics):
+        with self._log_lock:
+            self.log_dict[task.name][self._KEY_METRICS] = metrics
+            self._log_dirty = True
+        self._flush_event.set()
+
+    def record_killed_process(self, task, process):
+        """
+        Count the resource usage of a task process killed before it could finish, which the task's own metrics miss.
+        """
+        metrics = getattr(process, "resource_metrics", None) or {}
+        self.stats["killed_processes"] += 1
+        self.stats["killed_cpu_seconds"] += metrics.get("user_cpu", 0.0) + metrics.get("system_cpu", 0.0)
+        self.stats["killed_max_rss_kb"] = max(self.stats["killed_max_rss_kb"], metrics.get("max_rss_kb", 0))
+
+    def workflow_metrics(self):
+        """
+        Aggregate the per task metrics of this run into workflow level metrics.
+        """
+        now = time.time()
+        elapsed = now - self.started_time if self.started_time else 0.0
+        counts = collections.Counter(task.status for task in self.tasks)
+        finished = [task for task in self.tasks if task.metrics]
+        cpu_seconds = sum(task.metrics.get("user_cpu", 0.0) + task.metrics.get("system_cpu", 0.0) for task in finished)
+        # Work thrown away by killed attempts and duplicates still kept the machine busy
+        cpu_seconds += self.stats["killed_cpu_seconds"]
+        queue_waits = [task.metrics["queue_wait"] for task in finished if "queue_wait" in task.metrics]
+
+        metrics = {
+            "elapsed_seconds": elapsed,
+            "tasks_total": len(self.tasks),
+            "tasks_active": len(self.active_task_indexs),
+            "tasks_complete": len(self.complete_task_indexs),
+            "tasks_failed": len(self.failed_task_indexs),
+            "tasks_per_minute": 60.0 * len(finished) / elapsed if elapsed else 0.0,
+            "cpu_seconds": cpu_seconds,
+            # Fraction of the machine's cores kept busy by task processes
+            "utilisation": cpu_seconds / (elapsed * (os.cpu_count() or 1)) if elapsed else 0.0,
+            "queue_wait_mean_seconds": sum(queue_waits) / len(queue_waits) if queue_waits else 0.0,
+            "max_rss_kb": max(
+                [task.metrics.get("max_rss_kb", 0) for task in finished] + [self.stats["killed_max_rss_kb"]]),
+            "killed_processes": self.stats["killed_processes"],
+            "killed_cpu_seconds": self.stats["killed_cpu_seconds"],
+            "status_counts": dict(counts),
+        }
+        if self._topo_order is not None:
+            # Measured wall times where known, expected durations for the rest
+            durations = self.expected_durations()
+            for task in finished:
+                durations[task.index] = task.metrics["wall"]
+            metrics["critical_path_seconds"] = max(self.critical_path_lengths(durations), default=0.0)
+        return metrics
+
+    def write_metrics(self, force=False):
+        """
+        Save the workflow metrics, at most once per METRICS_INTERVAL unless forced.
+        """
+        if not self.metrics_format:
+            return
+        if not force and time.time() - self._metrics_written_time < self.METRICS_INTERVAL:
+            return
+        self._metrics_written_time = time.time()
+
+        metrics = self.workflow_metrics()
+        if self.metrics_format == "prometheus":
+            status_counts = metrics.pop("status_counts")
+            lines = list()
+            for key, value in sorted(metrics.items()):
+                lines.append("monitor_{}{{workflow=\"{}\"}} {}".format(key, self.name, value))
+            for status, count in sorted(status_counts.items()):
+                lines.append("monitor_tasks{{workflow=\"{}\",status=\"{}\"}} {}".format(self.name, status, count))
+            text = "\n".join(lines) + "\n"
+        else:
+            text = json.dumps(metrics, indent=4, sort_keys=True)
+
+        tmp_path = self.metrics_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(text)
+        os.replace(tmp_path, self.metrics_path)
+
+    def build_task_graph(self):
+        """
+        Index the prerequisites once, compute each task's critical path priority,
+        and queue the tasks that are ready now.
+        """
+        n_tasks = len(self.tasks)
+        self._dependents = [set() for _ in range(n_tasks)]
+        self._cancel_dependents = [set() for _ in range(n_tasks)]
+        self._unmet_prereq_counts = [0] * n_tasks
+        for task in self.tasks:
+            for prereq_index in task.prereq_indexs:
+                self._dependents[prereq_index].add(task.index)
+            for fail_index in task.cancel_if_fail_indexs:
+                self._cancel_dependents[fail_index].add(task.index)
+            self._unmet_prereq_counts[task.index] = len(task.prereq_indexs - self.complete_task_indexs)
+
+        # Topological order, so every task comes after all of its prerequisites
+        remaining = [len(task.prereq_indexs) for task in self.tasks]
+        order = [task.index for task in self.tasks if not remaining[task.index]]
+        for index in order:
+            for dependent_index in self._dependents[index]:
+                remaining[dependent_index] -= 1
+                if not remaining[dependent_index]:
+                    order.append(dependent_index)
+        if len(order) < n_tasks:
+            raise ValueError("Task prerequisites contain a cycle.")
+        self._topo_order = order
+
+        # Priority is the expected time from the start of the task to the end of its longest chain of dependents
+        self._priorities = self.critical_path_lengths(self.expected_durations())
+
+        self._ready_queue = list()
+        for task in self.tasks:
+            if task.status != Task.WAIT:
+                continue
+            if task.is_canceled():
+                task.set_status(Task.CANCELED)
+            elif not self._unmet_prereq_counts[task.index]:
+                self.push_ready(task)
+
+    def register_dynamic_task(self, task, priority=None):
+        """
+        Take in a task created while the workflow runs, such as a batch of a MapTask, after constructing it.
+        It gets a fresh log entry and a place in the task graph, and is queued if its prerequisites are complete.
+        Its prerequisites must be existing tasks, and no existing task can depend on it.
+        """
+        with self._log_lock:
+            self.log_dict[task.name] = {
+                self._KEY_LOG: list(),
+                self._KEY_CMD: task.exec_os_command,
+                self._KEY_STATUS: task.status,
+            }
+            self._log_dirty = True
+        self._flush_event.set()
+
+        if self._dependents is None:
+            # The graph is not built yet, build_task_graph will include the task
+            return
+        self._dependents.append(set())
+        self._cancel_dependents.append(set())
+        for prereq_index in task.prereq_indexs:
+            self._dependents[prereq_index].add(task.index)
+        for fail_index in task.cancel_if_fail_indexs:
+            self._cancel_dependents[fail_index].add(task.index)
+        self._unmet_prereq_counts.append(len(task.prereq_indexs - self.complete_task_indexs))
+        # Only depends on tasks that came before it
+        self._topo_order.append(task.index)
+        if priority is None:
+            priority = self.DEFAULT_DURATION
+        self._priorities.append(priority)
+
+        if task.is_canceled():
+            task.set_status(Task.CANCELED)
+        elif not self._unmet_prereq_counts[task.index]:
+            self.push_ready(task)
+
+    def push_ready(self, task):
+        task.ready_time = time.time()
+        heapq.heappush(self._ready_queue, (-self._priorities[task.index], task.index))
+
+    def task_finished(self, task):
+        """
+        Called when a task reaches a final status. Queues dependents that became ready,
+        and cancels queued dependents that should not run because this task failed.
+        """
+        if self._dependents is None:
+            # The graph is not built yet, build_task_graph will account for this task
+            return
+
+        if task.status == Task.DONE or task.status == Task.SKIP:
+            for dependent_index in self._dependents[task.index]:
+                self._unmet_prereq_counts[dependent_index] -= 1
+                dependent = self.tasks[dependent_index]
+                if not self._unmet_prereq_counts[dependent_index] and dependent.status == Task.WAIT:
+                    self.push_ready(dependent)
+        else:
+            for dependent_index in self._cancel_dependents[task.index]:
+                dependent = self.tasks[dependent_index]
+                if dependent.status == Task.WAIT:
+                    # This recurses so the whole downstream chain is canceled
+                    dependent.set_status(Task.CANCELED)
+
+    def schedule_retry(self, task, delay):
+        """
+        Queue the task again once delay seconds have passed.
+        """
+        heapq.heappush(self._retry_queue, (time.time() + delay, task.index))
+        self.wake()
+
+    def next_wait_timeout(self):
+        """
+        Seconds to wait for events before the next pass, the heartbeat unless a retry or a task timeout falls due sooner.
+        """
+        due = [
+            self.tasks[i].launched_time + self.tasks[i].timeout for i in self.active_task_indexs
+            if self.tasks[i].launched_time is not None
+        ]
+        if self.output_capture:
+            # Exited tasks whose output pipes are still open stop being waited for after a grace period
+            due.extend(
+                self.tasks[i].output_exit_time + self.output_capture.EXIT_GRACE for i in self.active_task_indexs
+                if self.tasks[i].output_exit_time is not None and self.tasks[i].open_output_streams
+            )
+        # Running speculative tasks are duplicated once they pass their median runtime by SPECULATIVE_FACTOR.
+        # Only when that is still to come, one already past is waiting for capacity, which frees up on an exit.
+        now = time.time()
+        due.extend(
+            speculation_time for speculation_time in (self.tasks[i].speculation_time() for i in self.active_task_indexs)
+            if speculation_time is not None and speculation_time > now
+        )
+        if self._retry_queue:
+            due.append(self._retry_queue[0][0])
+        if self._throttled:
+            due.append(time.time() + self.throttle.interval)
+        if due:
+            return max(0.0, min(self.REFRESH_RATE, min(due) - time.time()))
+        return self.REFRESH_RATE
+
+    def launch_ready_tasks(self):
+        """
+        Launch queued tasks in priority order for as long as there is capacity.
+        Tasks that do not fit go back in the queue so smaller ones can fill the gap.
+        """
+        # Retries whose backoff has passed are ready again
+        now = time.time()
+        while self._retry_queue and self._retry_queue[0][0] <= now:
+            task = self.tasks[heapq.heappop(self._retry_queue)[1]]
+            if task.status == Task.WAIT:
+                self.push_ready(task)
+
+        budget = self.throttle.launch_budget(self) if self.throttle and self._ready_queue else None
+        self._throttled = False
+        deferred = list()
+        while self._ready_queue:
+            if self.max_parallel is not None and len(self._resource_claims) >= self.max_parallel:
+                break
+            if budget is not None and budget <= 0:
+                # Look again shortly rather than at the next heartbeat
+                self._throttled = True
+                self.stats["throttled_ticks"] += 1
+                break
+            entry = heapq.heappop(self._ready_queue)
+            task = self.tasks[entry[1]]
+            if task.status != Task.WAIT:
+                continue
+            if self.has_capacity(task):
+                task.launch()
+                if budget is not None:
+                    budget -= 1
+            else:
+                deferred.append(entry)
+        for entry in deferred:
+            heapq.heappush(self._ready_queue, entry)
+
+    def _file_digest(self, path):
+        stat = os.stat(path)
+        memo_key = (path, stat.st_size, stat.st_mtime_ns)
+        if memo_key not in self._file_digests:
+            digest = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(block)
+            self._file_digests[memo_key] = digest.hexdigest()
+        return self._file_digests[memo_key]
+
+    def is_cacheable(self, task):
+        return bool(self.cache_dir and task.outputs and task.exec_os_command)
+
+    def cache_key(self, task):
+        """
+        Hash of the task's command and the contents of all of its inputs (files, or directories walked in order).
+        Returns None if the task is not cacheable or an input is missing.
+        """
+        if not self.is_cacheable(task):
+            return None
+        key = hashlib.sha256(task.exec_os_command.encode("utf-8"))
+        try:
+            for input_path in task.inputs:
+                key.update(b"\0" + input_path.encode("utf-8"))
+                if os.path.isdir(input_path):
+                    for root, dirnames, filenames in os.walk(input_path):
+                        dirnames.sort()
+                        for filename in sorted(filenames):
+                            file_path = os.path.join(root, filename)
+                            key.update(b"\0" + os.path.relpath(file_path, input_path).encode("utf-8"))
+                            key.update(self._file_digest(file_path).encode("ascii"))
+                else:
+                    key.update(self._file_digest(input_path).encode("ascii"))
+        except OSError:
+            return None
+        return key.hexdigest()
+
+    def _cache_entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _place(self, source, destination):
+        """
+        Link or copy a file or directory tree, replacing whatever is at the destination.
+        """
+        if os.path.isdir(destination) and not os.path.islink(destination):
+            shutil.rmtree(destination)
+        elif os.path.lexists(destination):
+            os.remove(destination)
+        parent_dir = os.path.dirname(destination)
+        if parent_dir:
+            os.makedirs(parent_dir, exist_ok=True)
+
+        def link_or_copy(src, dst):
+            if self.CACHE_LINK:
+                try:
+                    os.link(src, dst)
+                except OSError:
+                    # Different filesystem, or links not supported
+                    pass
+                else:
+                    os.chmod(dst, os.stat(dst).st_mode & 0o7555)
+                    return dst
+            return shutil.copy2(src, dst)
+
+        if os.path.isdir(source):
+            shutil.copytree(source, destination, copy_function=link_or_copy)
+        else:
+            link_or_copy(source, destination)
+
+    def restore_cached_result(self, task):
+        """
+        If the cache has the outputs of an identical run of the task, put them in place and return True.
+        Hashes the inputs, so this runs on the check pool rather than the monitor thread (see Task.launch).
+        """
+        task.cache_key = self.cache_key(task)
+        if task.cache_key is None:
+            return False
+        entry_dir = self._cache_entry_dir(task.cache_key)
+        if not os.path.isdir(entry_dir):
+            return False
+        try:
+            for i, output_path in enumerate(task.outputs):
+                self._place(os.path.join(entry_dir, str(i)), output_path)
+        except OSError as e:
+            self.error_log(task.name + " : Failed to restore cached outputs: " + str(e))
+            return False
+        return True
+
+    def store_cached_result(self, task):
+        """
+        Save the outputs of a successful run under the key computed when the task was launched.
+        Runs on the check pool, off the monitor thread.
+        """
+        if task.cache_key is None:
+            return
+        entry_dir = self._cache_entry_dir(task.cache_key)
+        if os.path.isdir(entry_dir):
+            return
+        os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+        # Fill a temporary directory then rename it, so a half stored entry is never used
+        tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(entry_dir))
+        try:
+            for i, output_path in enumerate(task.outputs):
+                self._place(output_path, os.path.join(tmp_dir, str(i)))
+            with open(os.path.join(tmp_dir, "manifest.json"), 'w') as f:
+                json.dump({self._KEY_CMD: task.exec_os_command, "inputs": task.inputs, "outputs": task.outputs}, f, indent=4)
+            os.rename(tmp_dir, entry_dir)
+        except OSError as e:
+            # Another workflow stored the same entry first, or an output is missing
+            self.error_log(task.name + " : Result not cached: " + str(e))
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def get_call_pool(self):
+        """
+        The process pool CallableTask functions run on, started on first use so the workers get the log settings.
+        """
+        if self.call_pool is None:
+            # Never forked from the monitor, whose threads may hold locks the child would inherit held
+            start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            log_environment = {key: os.environ.get(key) for key in (self.LOG_JSON, self.LOG_JOURNAL, self.LOG_SOCKET)}
+            self.call_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.CALL_WORKERS, mp_context=multiprocessing.get_context(start_method),
+                initializer=_init_call_worker, initargs=(log_environment,))
+        return self.call_pool
+
+    def has_capacity(self, task):
+        """
+        Check if the task fits within max_parallel and the free resource capacity.
+        A task asking for more than the total capacity of a resource is still admitted when nothing else holds it,
+        so that it runs alone rather than never.
+        """
+        if self.max_parallel is not None and len(self._resource_claims) >= self.max_parallel:
+            return False
+        for name, cost in task.resources.items():
+            capacity = self.resource_capacity.get(name)
+            if capacity is None:
+                continue
+            in_use = self._resources_in_use.get(name, 0)
+            if in_use and in_use + cost > capacity:
+                return False
+        return True
+
+    def claim_resources(self, task, claim_key=None):
+        # A task's speculative duplicate holds its own claim, under a different key
+        if claim_key is None:
+            claim_key = task.index
+        self._resource_claims[claim_key] = dict(task.resources)
+        for name, cost in task.resources.items():
+            self._resources_in_use[name] = self._resources_in_use.get(name, 0) + cost
+
+    def release_resources(self, task, claim_key=None):
+        if claim_key is None:
+            claim_key = task.index
+        claim = self._resource_claims.pop(claim_key, None)
+        if claim is None:
+            return
+        for name, cost in claim.items():
+            self._resources_in_use[name] -= cost
+
     def init_json_log(self):
         logs_json_dict = dict()
         if os.path.isfile(self.log_json_path):
-            logs_json_dict_old = file_utils.read_json_file_dict(self.log_json_path)
+            logs_json_dict_old = _file_utils().read_json_file_dict(self.log_json_path)
+            # Records left in the journal by an interrupted run belong to the old json data
+            self._journal_offset = 0
+            self._ingest_journal(logs_json_dict_old)
 
             # If a refresh timestamp was provided, then do not use old data unless timestamp is a match
             # If no refresh, then always use the old json data if it exists
@@ -121,8 +780,293 @@ class Monitor(object):
                     self._KEY_CMD: task.exec_os_command,
                     self._KEY_STATUS: task.status,
                 }
-        with open(self.log_json_path, 'w') as f:
-            json.dump(logs_json_dict, f, indent=4)
+
+        # From here on the monitor holds the authoritative log in memory and only the writer thread saves it
+        with self._log_lock:
+            self.log_dict = logs_json_dict
+            self._log_dirty = True
+        self.flush_json_log()
+        self._start_log_writer()
+        self._open_log_socket()
+
+    def _open_log_socket(self):
+        """
+        Listen for messages sent by log_string from subprocesses. Without a socket everything goes through the journal.
+        A receiver thread drains the socket as datagrams arrive, the kernel only queues a few of them.
+        """
+        if not hasattr(socket, "AF_UNIX"):
+            return
+        log_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            # Left behind by a monitor that was killed
+            if os.path.exists(self.log_socket_path):
+                os.unlink(self.log_socket_path)
+            log_socket.bind(self.log_socket_path)
+        except OSError as e:
+            # For example a path longer than a socket address allows
+            self.error_log("Not listening for log messages on a socket: " + str(e))
+            log_socket.close()
+            return
+        self._log_socket = log_socket
+        self._log_receiver_stop.clear()
+        self._log_receiver = threading.Thread(target=self._log_receiver_loop, name="monitor-log-receiver", daemon=True)
+        self._log_receiver.start()
+        os.environ[self.LOG_SOCKET] = self.log_socket_path
+
+    def _close_log_socket(self):
+        if self._log_socket is None:
+            return
+        os.environ.pop(self.LOG_SOCKET, None)
+        # Connected before the path goes away, to wake the receiver thread out of its wait
+        waker = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        waker.connect(self.log_socket_path)
+        # Unlink first, so senders fall back to the journal, then take whatever is still queued
+        try:
+            os.unlink(self.log_socket_path)
+        except OSError:
+            pass
+        self._log_receiver_stop.set()
+        try:
+            waker.send(b"", socket.MSG_DONTWAIT)
+        except OSError:
+            # Queue full, so the receiver is not waiting anyway
+            pass
+        waker.close()
+        self._log_receiver.join()
+        self._log_receiver = None
+        self._log_socket.setblocking(False)
+        self._receive_log_datagrams()
+        self._log_socket.close()
+        self._log_socket = None
+
+    def _log_receiver_loop(self):
+        while not self._log_receiver_stop.is_set():
+            self._receive_log_datagrams()
+
+    def _receive_log_datagrams(self):
+        """
+        Wait for a message on the log socket, then apply it and everything else already queued as one batch.
+        """
+        records = list()
+        try:
+            data = self._log_socket.recv(self.LOG_DATAGRAM_MAX)
+            while True:
+                try:
+                    records.append(json.loads(data.decode("utf-8")))
+                except ValueError:
+                    pass
+                data = self._log_socket.recv(self.LOG_DATAGRAM_MAX, socket.MSG_DONTWAIT)
+        except (BlockingIOError, InterruptedError):
+            pass
+        if not records:
+            return
+        self.stats["log_datagrams"] += len(records)
+        with self._log_lock:
+            for record in records:
+                self._apply_journal_record(self.log_dict, record)
+            self._log_dirty = True
+        self._flush_event.set()
+
+    def _ingest_journal(self, logs_json_dict):
+        """
+        Apply journal records appended since the last call, starting from the remembered byte offset.
+        Only complete lines are consumed, a line still being written is picked up next time.
+        Returns True if anything was applied.
+        """
+        try:
+            if os.stat(self.log_journal_path).st_size <= self._journal_offset:
+                return False
+            with open(self.log_journal_path, 'rb') as f_journal:
+                f_journal.seek(self._journal_offset)
+                data = f_journal.read()
+        except FileNotFoundError:
+            return False
+
+        end = data.rfind(b"\n") + 1
+        if not end:
+            return False
+        self._journal_offset += end
+        self.stats["journal_bytes_read"] += end
+
+        for line in data[:end].splitlines():
+            try:
+                record = json.loads(line.decode("utf-8"))
+            except ValueError:
+                # Partial line from a writer that died mid append
+                continue
+            self._apply_journal_record(logs_json_dict, record)
+        return True
+
+    def apply_log_record(self, record):
+        """
+        Apply a journal record received by some other route than the journal file, for example from a remote worker.
+        """
+        with self._log_lock:
+            self._apply_journal_record(self.log_dict, record)
+            self._log_dirty = True
+        self._flush_event.set()
+
+    def poll_json_log(self):
+        """
+        Pick up messages logged by subprocesses since the last poll.
+        """
+        with self._log_lock:
+            if self._ingest_journal(self.log_dict):
+                self._log_dirty = True
+                self._flush_event.set()
+
+    def record_status(self, task):
+        """
+        Save a task status change to the in memory log, the writer thread will save it to file.
+        """
+        with self._log_lock:
+            self.log_dict[task.name][self._KEY_STATUS] = task.status
+            self._log_dirty = True
+        self._flush_event.set()
+
+    def last_message(self, task_key):
+        """
+        Return the most recent message entry logged for the task, or None if none yet.
+        """
+        with self._log_lock:
+            try:
+                return self.log_dict[task_key][self._KEY_LOG][-1]
+            except (KeyError, IndexError):
+                return None
+
+    def flush_json_log(self):
+        """
+        Save the in memory log to the json log if anything changed, then empty the journal if all of it is saved.
+        The json log is replaced atomically so readers never see a half written file.
+        """
+        with self._log_lock:
+            if not self._log_dirty:
+                return
+            # Serializing a large log takes long enough to stall the monitor thread, so only a snapshot is taken
+            # under the lock. Entry values are replaced rather than changed, except the message lists appended to.
+            snapshot = {
+                name: {key: list(value) if isinstance(value, list) else value for key, value in entry.items()}
+                if isinstance(entry, dict) else entry
+                for name, entry in self.log_dict.items()
+            }
+            saved_offset = self._journal_offset
+            self._log_dirty = False
+
+        log_text = self._encode_log(snapshot)
+
+        tmp_path = self.log_json_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(log_text)
+        os.replace(tmp_path, self.log_json_path)
+        self.stats["log_writes"] += 1
+        self.stats["log_bytes_written"] += len(log_text)
+
+        with self._log_lock:
+            if self._journal_offset != saved_offset:
+                # More records were applied while saving, they get truncated after the next save
+                return
+            try:
+                f_journal = open(self.log_journal_path, 'r+b')
+            except FileNotFoundError:
+                return
+            try:
+                if fcntl:
+                    fcntl.flock(f_journal, fcntl.LOCK_EX)
+                if os.fstat(f_journal.fileno()).st_size == self._journal_offset:
+                    f_journal.truncate()
+                    self._journal_offset = 0
+            finally:
+                # Closing the file also releases the lock
+                f_journal.close()
+
+    def _encode_log(self, snapshot):
+        """
+        The same text as json.dumps(snapshot, indent=4, sort_keys=True), with the text of each entry kept from the
+        last save and only encoded again if the entry changed. Comparing an entry is much cheaper than encoding it.
+        """
+        encoded = dict()
+        parts = list()
+        for name in sorted(snapshot):
+            entry = snapshot[name]
+            cached = self._encoded_entries.get(name)
+            if cached is None or cached[0] != entry:
+                cached = (entry, json.dumps(entry, indent=4, sort_keys=True).replace("\n", "\n    "))
+            encoded[name] = cached
+            parts.append("    " + json.dumps(name) + ": " + cached[1])
+        self._encoded_entries = encoded
+        if not parts:
+            return "{}"
+        return "{\n" + ",\n".join(parts) + "\n}"
+
+    def _start_log_writer(self):
+        if self._log_writer is not None:
+            return
+        self._log_writer_stop.clear()
+        self._log_writer = threading.Thread(target=self._log_writer_loop, name="monitor-log-writer", daemon=True)
+        self._log_writer.start()
+
+    def _log_writer_loop(self):
+        # Changes made within one FLUSH_INTERVAL are coalesced into a single write
+        while not self._log_writer_stop.is_set():
+            self._flush_event.wait()
+            self._flush_event.clear()
+            flush_start = time.thread_time()
+            try:
+                self.flush_json_log()
+            except Exception as e:
+                self.error_log("Failure to save json log: " + str(e))
+            # Kept apart from the tick time, this thread runs alongside the monitor thread
+            self.stats["log_writer_cpu_seconds"] += time.thread_time() - flush_start
+            self._log_writer_stop.wait(self.FLUSH_INTERVAL)
+
+    def close_json_log(self):
+        """
+        Stop the writer thread and save everything that is left.
+        """
+        if self._log_writer is not None:
+            self._log_writer_stop.set()
+            self._flush_event.set()
+            self._log_writer.join()
+            self._log_writer = None
+        self._close_log_socket()
+        self.poll_json_log()
+        self.flush_json_log()
+
+    @classmethod
+    def _apply_journal_record(cls, logs_json_dict, record):
+        """
+        Apply one journal record (a status change and/or a message) to the json log dict.
+        """
+        task_key = record.get(cls._KEY_TASK)
+        if task_key not in logs_json_dict:
+            # Only the debug key is allowed to be added on the fly, same as log_string always did
+            if task_key != DEBUG_TASK_KEY:
+                return
+            logs_json_dict[task_key] = {cls._KEY_LOG: list()}
+
+        if cls._KEY_STATUS in record:
+            logs_json_dict[task_key][cls._KEY_STATUS] = record[cls._KEY_STATUS]
+        if cls._KEY_MESSAGE in record:
+            logs_json_dict[task_key].setdefault(cls._KEY_LOG, list()).append(
+                {
+                    cls._KEY_MESSAGE: record[cls._KEY_MESSAGE],
+                    cls._KEY_TIMESTAMP: record[cls._KEY_TIMESTAMP],
+                }
+            )
+
+    @classmethod
+    def send_log_datagram(cls, socket_path, record):
+        """
+        Send one json record to a monitor's log socket, see monitor_client.send_log_datagram.
+        """
+        return monitor_client.send_log_datagram(socket_path, record)
+
+    @classmethod
+    def journal_append(cls, journal_path, record):
+        """
+        Append one json record as a single line to the journal, see monitor_client.journal_append.
+        """
+        monitor_client.journal_append(journal_path, record)
 
 
     def error_log(self, *arg):
@@ -135,139 +1079,227 @@ class Monitor(object):
         # # Need to reset sys.stdout after back to default
         # sys.stdout = sys.__stdout__
 
+    def _install_child_watch(self):
+        """
+        Route SIGCHLD into a wakeup pipe so that wait_for_event returns as soon as a child exits.
+        Signal handlers can only be installed from the main thread, otherwise this falls back to plain sleeping.
+        """
+        if not self.event_driven or not hasattr(signal, "SIGCHLD"):
+            return
+        if threading.current_thread() is not threading.main_thread():
+            return
+
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
+
+        # The python level handler does nothing, the C level handler writes the signal number to the wakeup fd
+        # which is what actually interrupts the select call.
+        self._old_sigchld = signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        self._old_wakeup_fd = signal.set_wakeup_fd(self._wakeup_w)
+
+    def _uninstall_child_watch(self):
+        if self._selector is None:
+            return
+        signal.set_wakeup_fd(self._old_wakeup_fd)
+        signal.signal(signal.SIGCHLD, self._old_sigchld)
+        self._selector.close()
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
+        self._selector = None
+        self._wakeup_r = None
+        self._wakeup_w = None
+
+    def watch_fd(self, fd):
+        """
+        Wake the main loop once when fd becomes readable, for example a pidfd when its process exits.
+        """
+        if self._selector is not None:
+            self._selector.register(fd, selectors.EVENT_READ)
+
+    def unwatch_fd(self, fd):
+        """
+        Stop watching fd, which must be done before closing it, as its number may be reused.
+        """
+        if self._selector is not None:
+            try:
+                self._selector.unregister(fd)
+            except KeyError:
+                # Already unregistered when it woke the main loop
+                pass
+
+    def wake(self):
+        """
+        Wake the main loop early. Safe to call from any thread.
+        """
+        if self._wakeup_w is not None:
+            try:
+                os.write(self._wakeup_w, b"\0")
+            except (BlockingIOError, OSError):
+                # Pipe is full, so a wakeup is already pending
+                pass
+
+    def wait_for_event(self, timeout):
+        """
+        Block until a child process exits, something calls wake, or the timeout (heartbeat) elapses.
+        """
+        if self._selector is None:
+            time.sleep(timeout)
+            return
+
+        for key, _ in self._selector.select(timeout):
+            if key.fileobj != self._wakeup_r:
+                # A watched fd only wakes once
+                self._selector.unregister(key.fileobj)
+                continue
+            # Drain the pipe, many signals may have arrived and one pass of task updates handles them all
+            try:
+                while os.read(self._wakeup_r, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def load_task_states(self):
+        """
+        Sort the tasks into the complete, failed and active sets from the statuses loaded from the json log.
+        """
+        for task in self.tasks:
+            if task.status == Task.DONE or task.status == Task.SKIP:
+                self.complete_task_indexs.add(task.index)
+                self.active_task_indexs.discard(task.index)
+            elif task.status == Task.FAILED or task.status == Task.CANCELED:
+                self.failed_task_indexs.add(task.index)
+                self.active_task_indexs.discard(task.index)
+            elif task.status == Task.ACTIVE:
+                # Left active by an interrupted run. Keep following its process if it is still running,
+                # otherwise queue it again (unless its check_if_done_fn shows it finished).
+                if task.reattach():
+                    self.active_task_indexs.add(task.index)
+                else:
+                    task.set_status(Task.WAIT)
+
+    def update_all_and_wait(self):
+        """
+        Update every waiting or active task, waiting for the first results of their check functions.
+        All checks run in parallel. This is used once at start, so tasks that are already done are never relaunched.
+        """
+        tasks = [task for task in self.tasks if task.status == Task.WAIT or task.status == Task.ACTIVE]
+        for task in tasks:
+            task.update()
+        pending = [future for task in tasks for future in task.check_futures.values()]
+        concurrent.futures.wait(pending, timeout=self.CHECK_TIMEOUT)
+        for task in tasks:
+            if task.status == Task.WAIT or task.status == Task.ACTIVE:
+                task.update()
+
     def start(self):
         """
         Take over console for status monitoring, check status of all tasks, then monitor and run all incomplete tasks.
         """
+        try:
+            self.run()
+
+        except:
+            # End the monitor and restore the terminal to its original operating mode
+            import traceback
+            err = sys.exc_info()
+            tb = traceback.format_exc()
+            print(err, file=sys.stderr)
+            print(tb, file=sys.stderr)
+
+        finally:
+            exit()
+
+    def run(self):
+        """
+        Run the workflow until nothing is running or ready to run, and return the final status of each task by name.
+        Unlike start, this returns to the caller and lets exceptions through.
+        """
 
         self.init_json_log()
+        self._install_child_watch()
+        self.renderer.install()
+        self.started_time = time.time()
 
         try:
-            for task in self.tasks:
-                if task.status == Task.DONE or task.status == Task.SKIP:
-                    self.complete_task_indexs.add(task.index)
-                    self.active_task_indexs.discard(task.index)
-                elif task.status == Task.FAILED or task.status == Task.CANCELED:
-                    self.failed_task_indexs.add(task.index)
-                    self.active_task_indexs.discard(task.index)
+            if self.output_capture:
+                self.output_capture.start(self)
+            self.executor.start(self)
+            self.load_task_states()
 
             # Check if tasks are complete.
-            for task in self.tasks:
-                if task.status == Task.WAIT or task.status == Task.ACTIVE:
-                    task.update()
+            self.poll_json_log()
+            self.update_all_and_wait()
 
-            # Launch all tasks that are not complete if the prerequisites are complete
-            for task in self.tasks:
-                if task.status == task.WAIT and task.is_ready():
-                    task.launch()
-                    time.sleep(2) # Stagger launches
-
-            # Until broken, check if current task is complete.
-            # If current task is complete, launch and monitor the next task if it exists.
-            # Stop looping when the set of completed tasks is as long as the task list
-            while len(self.complete_task_indexs) < len(self.tasks):
-                self.print_status()
-                time.sleep(self.REFRESH_RATE)
+            # Launch all tasks that are not complete if the prerequisites are complete and there is capacity
+            self.build_task_graph()
+            self.launch_ready_tasks()
+            self.print_status()
+
+            # Until broken, check if active tasks are complete.
+            # When a task completes, its dependents that became ready are queued and launched.
+            # Stop looping when nothing is running and nothing is ready to run
+            while self.active_task_indexs or self._ready_queue or self._retry_queue:
+                self.wait_for_event(self.next_wait_timeout())
+                tick_start = time.thread_time()
+                self.poll_json_log()
+                if self.output_capture:
+                    self.output_capture.deliver()
 
                 # For all sctive tasks, check if they are complete
                 active_tasks = [self.tasks[i] for i in self.active_task_indexs]
                 for active_task in active_tasks:
                     active_task.update()
 
-                # For all queued tasks, launch if they are now ready
-                queued_tasks = [task for task in self.tasks if task.index not in self.complete_task_indexs|self.active_task_indexs|self.failed_task_indexs]
-                for task in queued_tasks:
-                    if task.is_ready():
-                        task.launch()
-                        time.sleep(2) # Stagger launches
-                    elif task.is_canceled():
-                        task.set_status(task.CANCELED)
+                # Launch queued tasks that are now ready
+                self.launch_ready_tasks()
+                self.write_metrics()
+                self.print_status()
 
-        except:
-            # End the monitor and restore the terminal to its original operating mode
-            import traceback
-            err = sys.exc_info()
-            tb = traceback.format_exc()
-            print(err, file=sys.stderr)
-            print(tb, file=sys.stderr)
+                # Scheduler overhead, everything but the waiting, of this thread only: the log writer, the log
+                # receiver and the check pool are busy at the same time
+                tick_cpu = time.thread_time() - tick_start
+                self.stats["ticks"] += 1
+                self.stats["tick_cpu_seconds"] += tick_cpu
+                self.stats["max_tick_cpu_seconds"] = max(self.stats["max_tick_cpu_seconds"], tick_cpu)
 
-        else:
-            # Print final status to terminal and wait a while before shutting down the monitor
+            # Print final status to terminal
             self.print_status()
 
         finally:
             # End the monitor and restore the terminal to its original operating mode
-            exit()
-
+            self._uninstall_child_watch()
+            self.renderer.uninstall()
+            self.executor.close()
+            if self.output_capture:
+                self.output_capture.close()
+            self.check_pool.shutdown(wait=False)
+            if self.call_pool is not None:
+                self.call_pool.shutdown(wait=False, cancel_futures=True)
+                self.call_pool = None
+            self.write_metrics(force=True)
+            self.close_json_log()
+
+        return {task.name: task.status for task in self.tasks}
 
     def print_status(self):
         """
         Print a status table in the console.
-        This will clear the terminal and print from the top left.
+        Only the rows that changed since the last call are redrawn, see StatusRenderer.
         """
-
-        # Get the terminal current window size and update the cursor object to be aware of this
-        w_height, w_width = os.popen('stty size', 'r').read().split()
-        w_height = int(w_height)
-        w_width = int(w_width)
-
-        print("\n"*(w_height+5))
-        print(self.name.upper())
-        print(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-        print(self.HEADER)
-        lines_written = 3
-        for task in self.tasks:
-            lines_written += 2
-            if lines_written <= w_height:
-                print("")
-                text = self.TEMPLATE.format(task.status, task.name, task.info)
-                text = (text[:w_width-2] + '..') if len(text) > w_width else text
-                print(text)
-            else:
-                # This is meant to be in case there is not room to print more lines, stop printing
-                continue
-        if lines_written < w_height: 
-            print('\n'*(w_height-(lines_written+2)))
+        self.renderer.render()
 
     @classmethod
     def log_string(cls, message, task_key=None):
         """
         This writes a message to the monitor log. Rather than using an instance Monitor object to get the log path,
         the system environment variable is used, so that this can be called by importing Monitor with no need to retain a reference
-        to the active monitor object.
+        to the active monitor object. Commands that only log should import monitor_client and call its log_string,
+        which this delegates to, and save importing all of this module.
         """
-        try:
-            if os.environ[cls.LOG_JSON] and task_key:
-                logs_json_fie, logs_json_dict = file_utils.checkout_json_file(os.environ[cls.LOG_JSON])
-
-                try:
-                    logs_json_dict[task_key][cls._KEY_LOG].append(
-                        {
-                            cls._KEY_MESSAGE: message,
-                            cls._KEY_TIMESTAMP: datetime.datetime.now().strftime('%m/%d %H:%M:%S')
-                        }
-                    )
-                    file_utils.save_json_file(logs_json_fie, logs_json_dict)
-
-                except KeyError:
-                    if task_key == DEBUG_TASK_KEY:
-                        logs_json_dict[task_key] = {
-                            cls._KEY_LOG: [
-                                {
-                                    cls._KEY_MESSAGE: message,
-                                    cls._KEY_TIMESTAMP: datetime.datetime.now().strftime('%m/%d %H:%M:%S'),
-                                },
-                            ],
-                        }
-                        file_utils.save_json_file(logs_json_fie, logs_json_dict)
-
-                finally:
-                    file_utils.release_file(logs_json_fie)
-
-            else:
-                print(message)
-        except:
-            print(message)
+        monitor_client.log_string(message, task_key)
 
 
 class Task(object):
@@ -284,7 +1316,8 @@ class Task(object):
     CANCELED = "Canceled."
 
 
-    def __init__(self, monitor, name, exec_os_command, check_if_done_fn, check_if_skip_fn=None, prereq_indexs=None, cancel_if_fail_indexs=None, timeout=12000):
+    def __init__(self, monitor, name, exec_os_command, check_if_done_fn, check_if_skip_fn=None, prereq_indexs=None, cancel_if_fail_indexs=None, timeout=12000, resources=None,
+                 inputs=None, outputs=None, retry=None, speculative=False, nice=None, ionice=None):
 
         ##############################################
         # Dependent on input properties
@@ -298,8 +1331,8 @@ class Task(object):
         # Must define the logging key in the task's script and maintain uniqueness manually
         self.timeout = timeout
 
-        self.log_err_path = os.path.join(monitor.log_dump_dir, file_utils.clean_filename(name) + ".err")
-        self.log_out_path = os.path.join(monitor.log_dump_dir, file_utils.clean_filename(name) + ".out")
+        self.log_err_path = os.path.join(monitor.log_dump_dir, _file_utils().clean_filename(name) + ".err")
+        self.log_out_path = os.path.join(monitor.log_dump_dir, _file_utils().clean_filename(name) + ".out")
 
         # This could be used to manage parallel tasks
         if prereq_indexs is None:
@@ -311,12 +1344,56 @@ class Task(object):
             cancel_if_fail_indexs = set(self.prereq_indexs)
         self.cancel_if_fail_indexs = set(cancel_if_fail_indexs)
 
+        # Resource costs claimed from the monitor's capacity while running, for example {"cpu": 4, "licence": 1}
+        self.resources = dict(resources or {})
+
+        # Paths read and written by the command, used by the monitor's result cache if it has one
+        self.inputs = list(inputs or [])
+        self.outputs = list(outputs or [])
+        self.cache_key = None
+        self._cache_lookup = None
+
+        # A RetryPolicy to run the task again when it fails, or None to fail on the first failure
+        self.retry = retry
+        self.attempt = 1
+        # Only for tasks that are safe to run twice at once: when running well past its median runtime,
+        # a duplicate is launched and whichever finishes first is kept (see Monitor.SPECULATIVE_FACTOR)
+        self.speculative = speculative
+        self.duplicate = None
+        self._speculated = False
+
+        # Run the command at this niceness (0 to 19), and this io scheduling class (1 realtime, 2 best effort, 3 idle)
+        # or (class, level), see set_process_priority
+        self.nice = nice
+        self.ionice = ionice
+
         # Standard starting state properties
         # Status is to be a status from the set of standard task statuses
         self.status = self.WAIT
         # Info is a string of whatever extra notes the user should see about the status of the task
         self.info = "..."
         self.launched_time = None
+        # When the task was last queued as ready, and the metrics of its last run by this monitor
+        self.ready_time = None
+        self.metrics = dict()
+        # Check functions in flight on the monitor's thread pool, and their last results, by kind ("done"/"skip")
+        self.check_futures = dict()
+        self._check_started = dict()
+        self._check_state = dict()
+        self._check_results = dict()
+        self._check_timed_out = set()
+        # Last lines of output, as (time, line), and the number of output pipes still open, when output is captured,
+        # and when the process was seen to exit while they were still open
+        self.output_captured = False
+        self.output_tail = None
+        self.open_output_streams = 0
+        self.output_exit_time = None
+        self._last_entry = None
+        self._last_entry_time = 0
+        # Stderr before this byte offset has already been scanned for errors, and where the current attempt's starts
+        self._err_offset = 0
+        self._attempt_err_offset = 0
+        self._error_found = False
 
         # Add self to the parent monitor's task list
         self.index = monitor.add_task(self)
@@ -336,32 +1413,93 @@ class Task(object):
         Set status attribute and save to json log
         """
         self.status = status_code
-        json_log_file, log_dict = file_utils.checkout_json_file(self.monitor.log_json_path)
-        log_dict[self.name][self.monitor._KEY_STATUS] = self.status
-        file_utils.save_json_file(json_log_file, log_dict)
+        self.monitor.record_status(self)
+        self.monitor.renderer.task_changed(self.index)
+
+        # Keep the runtime of tasks launched by this monitor, for critical path priorities in later runs
+        if self.status == Task.DONE and self.process is not None and self.launched_time is not None:
+            self.monitor.record_duration(self, time.time() - self.launched_time)
+            if self.cache_key is not None:
+                # Copying large outputs takes a while, nothing waits for it
+                self.monitor.check_pool.submit(self.monitor.store_cached_result, self)
+
+        if self.status != Task.ACTIVE and self.status != Task.WAIT and self.process is not None and not self.metrics:
+            self.collect_metrics()
+
+        if self.duplicate is not None and self.status != Task.ACTIVE:
+            self.drop_duplicate()
 
         if self.status == Task.DONE or self.status == Task.SKIP:
             self.monitor.complete_task_indexs.add(self.index)
             self.monitor.active_task_indexs.discard(self.index)
+            self.monitor.release_resources(self)
+            self.monitor.task_finished(self)
         elif self.status == Task.FAILED or self.status == Task.CANCELED:
             self.monitor.failed_task_indexs.add(self.index)
             self.monitor.active_task_indexs.discard(self.index)
+            self.monitor.release_resources(self)
+            self.monitor.task_finished(self)
+
+    def find_error_in_log(self, final=False):
+        """
+        Scan the stderr written since the last scan for error patterns, and add any error lines to the error summary.
+        Only complete lines are scanned unless final is set, in which case the unterminated last line is included too.
+        Returns True if an error has been found since the task was launched.
+        """
+        if self.output_captured:
+            # Stderr is scanned as it comes through the pipe
+            return self._error_found
 
-    def find_error_in_log(self):
-        error_found = False
-        with open(self.log_err_path , 'r') as f_err:
-            line = f_err.readline()
-            while line:
-                if "Error:" in line:
-                    with open(self.monitor.log_testing , 'a+') as f_dump:
-                        f_dump.write("\n\n" + str(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')) + "\n")
-                        f_dump.write(self.name + "\n")
-                        f_dump.write(line)
-                        f_dump.write("For more info see file:\n")
-                        f_dump.write(self.log_err_path)
-                        error_found = True
-                line = f_err.readline()
-        return error_found
+        try:
+            f_err = open(self.log_err_path, 'rb')
+        except FileNotFoundError:
+            return self._error_found
+
+        error_lines = list()
+        with f_err:
+            f_err.seek(self._err_offset)
+            pending = b""
+            while True:
+                chunk = f_err.read(self.monitor.ERROR_SCAN_CHUNK)
+                if not chunk:
+                    break
+                data = pending + chunk
+                end = data.rfind(b"\n") + 1
+                pending = data[end:]
+                error_lines.extend(self._match_error_lines(data[:end]))
+                self._err_offset += end
+            if final and pending:
+                error_lines.extend(self._match_error_lines(pending))
+                self._err_offset += len(pending)
+
+        self.report_error_lines(error_lines)
+        return self._error_found
+
+    def report_error_lines(self, error_lines):
+        """
+        Add the error lines to the error summary with one open, and remember that the task had errors.
+        """
+        if error_lines:
+            self._error_found = True
+            timestamp = str(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+            with open(self.monitor.log_testing, 'a+') as f_dump:
+                for line in error_lines:
+                    f_dump.write("\n\n" + timestamp + "\n")
+                    f_dump.write(self.name + "\n")
+                    f_dump.write(line)
+                    f_dump.write("For more info see file:\n")
+                    f_dump.write(self.log_err_path)
+
+    def _match_error_lines(self, data):
+        """
+        Return the lines of data (bytes of whole lines) that contain an error pattern, each line once, in order.
+        """
+        text = data.decode("utf-8", errors="replace")
+        line_starts = set()
+        for regex in self.monitor.error_regexes:
+            for match in regex.finditer(text):
+                line_starts.add(text.rfind("\n", 0, match.start()) + 1)
+        return [text[line_start:text.find("\n", line_start) + 1 or len(text)] for line_start in sorted(line_starts)]
 
     # def log_output(self):
     #     '''
@@ -386,15 +1524,31 @@ class Task(object):
 
     def update(self):
 
-        # TODO: What if self.process is None, becuase the monitor was closed and resumed...?
+        if self._cache_lookup is not None:
+            # Nothing runs until the cache lookup started by launch is over
+            self.finish_cache_lookup()
+            if self._cache_lookup is not None or self.status != self.ACTIVE:
+                return
+
+        # After a resume an active task has either been reattached to its running process or put back to WAIT
+        # (see Monitor.load_task_states), so a missing process only means the launch has not got one yet.
+        return_code = self.process.poll() if self.process else None
+        if self.duplicate is not None and self.settle_duplicate(return_code):
+            return_code = self.process.poll()
+        if self.duplicate is not None and return_code:
+            # Failed, but its duplicate may still succeed
+            return_code = None
+        if self.output_pending(self, return_code):
+            # Not finished until all of its output has been read
+            return_code = None
 
         if self.is_canceled():
             self.set_status(self.CANCELED)
 
-        elif self.is_skip():
+        elif self.check_in_pool("skip", self.check_if_skip_fn, return_code):
             self.set_status(self.SKIP)
 
-        elif self.check_if_done_fn():
+        elif self.check_in_pool("done", self.check_if_done_fn, return_code):
             self.set_status(self.DONE)
 
         elif self.status == self.ACTIVE:
@@ -402,37 +1556,226 @@ class Task(object):
                 self.launched_time = time.time()
 
             if self.process:
-                return_code = self.process.poll()
-                if return_code is None:
-                    # Process seems to still be running, check if it has exceeded max runtime
-                    if (time.time() - self.launched_time) > self.timeout:
-                        self.monitor.error_log(self.name + " : Process timed out.")
-                        self.set_status(self.FAILED)
-                else:
-                    if return_code:
-                        self.set_status(self.FAILED)
-                    elif self.find_error_in_log():
-                        self.set_status(self.FAILED)
-            # TODO: What if self.process is None, becuase the monitor was closed and resumed...?
-            # else:
-            #     self.set_status(self.FAILED)
-
-        log_dict = file_utils.read_json_file_dict(self.monitor.log_json_path)
-        # Make sure keys exist in json
-        try:
-            log_dict[self.name][self.monitor._KEY_LOG]
-        except KeyError:
-            self.monitor.init_json_log()
-            log_dict = file_utils.read_json_file_dict(self.monitor.log_json_path)
+                self.update_from_return_code(return_code)
+                if self.status == self.ACTIVE and return_code is None:
+                    self.speculate()
+
+        self.update_info()
+
+    def output_pending(self, run, return_code):
+        """
+        True while the captured output of run (the task or its duplicate), whose process exited with return_code,
+        may still be arriving. A process left running in the background can hold the pipes open indefinitely,
+        so they are only waited for OutputCapture.EXIT_GRACE seconds after the exit, then read no further.
+        """
+        if return_code is None or not run.open_output_streams:
+            return False
+        now = time.time()
+        if run.output_exit_time is None:
+            run.output_exit_time = now
+        elif now - run.output_exit_time >= self.monitor.output_capture.EXIT_GRACE:
+            self.monitor.output_capture.detach(run)
+        return True
+
+    def check_in_pool(self, kind, check_fn, return_code):
+        """
+        Run a check function on the monitor's thread pool without waiting for it.
+        Returns the latest known result, which is False while the first call is still running.
+        The monitor is woken when a result arrives.
+        """
+        if check_fn is None:
+            return False
+
+        state = (self.status, return_code)
+        now = time.time()
+        future = self.check_futures.get(kind)
+        if future is not None:
+            if not future.done():
+                if now - self._check_started[kind] > self.monitor.CHECK_TIMEOUT and kind not in self._check_timed_out:
+                    self._check_timed_out.add(kind)
+                    self.monitor.error_log(self.name + " : check " + kind + " timed out.")
+                return False if kind in self._check_timed_out else self._check_results.get(kind, (False,))[0]
+
+            del self.check_futures[kind]
+            self._check_timed_out.discard(kind)
+            try:
+                result = bool(future.result())
+            except Exception as e:
+                self.monitor.error_log(self.name + " : check " + kind + " raised: " + str(e))
+                result = False
+            self._check_results[kind] = (result, self._check_state[kind], now)
+
+        memo = self._check_results.get(kind)
+        if memo is None or memo[1] != state or now - memo[2] > self.monitor.CHECK_MEMO_TTL:
+            future = self.monitor.check_pool.submit(check_fn)
+            self._check_started[kind] = now
+            self._check_state[kind] = state
+            self.check_futures[kind] = future
+            future.add_done_callback(lambda f: self.monitor.wake())
+
+        return memo[0] if memo else False
+
+    def check_settled(self, kind, check_fn, return_code):
+        """
+        True if the latest result of the check was computed for the task's current status and return code,
+        with no newer call in flight, or there is no such check.
+        """
+        if check_fn is None:
+            return True
+        memo = self._check_results.get(kind)
+        return kind not in self.check_futures and memo is not None and memo[1] == (self.status, return_code)
 
+    def update_from_return_code(self, return_code):
+        """
+        Set the status of an active task from its process return code, None meaning still running.
+        """
+        if return_code is None:
+            # Process seems to still be running, check if it has exceeded max runtime
+            if (time.time() - self.launched_time) > self.timeout:
+                self.monitor.error_log(self.name + " : Process timed out.")
+                self.attempt_failed(None, timed_out=True)
+            else:
+                # Keep up with stderr while running so there is little left to scan at exit
+                self.find_error_in_log()
+        else:
+            if return_code:
+                self.attempt_failed(return_code)
+            elif self.find_error_in_log(final=True):
+                self.attempt_failed(return_code)
+            elif (not getattr(self.process, "exit_code_known", True)
+                  and self.check_settled("done", self.check_if_done_fn, return_code)):
+                # Exited while reattached, so its exit code is unknown, and its done check says it did not finish
+                self.monitor.error_log(self.name + " : Reattached process exited with an unknown exit code, not done.")
+                self.attempt_failed(return_code)
+
+    def attempt_failed(self, return_code, timed_out=False):
+        """
+        Fail the task, unless its retry policy says to run it again, in which case it is queued after the backoff.
+        """
+        if self.retry is None or not self.retry.should_retry(self, return_code, timed_out):
+            self.set_status(self.FAILED)
+            return
+
+        delay = self.retry.delay(self.attempt)
+        self.monitor.error_log(self.name + " : Attempt " + str(self.attempt) + " failed, retrying in "
+                               + "{:.1f}".format(delay) + " s.")
+        if timed_out:
+            self.kill_process(self.process)
+        self.attempt += 1
+        self.info = "Retry {} of {} in {:.0f} s".format(self.attempt, self.retry.max_attempts, delay)
+        self.set_status(self.WAIT)
+        self.monitor.active_task_indexs.discard(self.index)
+        self.monitor.release_resources(self)
+        self.monitor.schedule_retry(self, delay)
+
+    def attempt_stderr(self):
+        """
+        The end of the stderr of the current attempt, for matching retry patterns.
+        """
+        if self.output_captured:
+            return "\n".join(line for line_time, line in self.output_tail or ())
         try:
-            # Only update info message if there is at least one message
-            if log_dict[self.name][self.monitor._KEY_LOG]:
-                ts = log_dict[self.name][self.monitor._KEY_LOG][-1][self.monitor._KEY_TIMESTAMP]
-                msg = log_dict[self.name][self.monitor._KEY_LOG][-1][self.monitor._KEY_MESSAGE]
-                self.info = ts + ": " + msg
-        except:
-            pass
+            with open(self.log_err_path, 'rb') as f_err:
+                f_err.seek(max(self._attempt_err_offset, os.fstat(f_err.fileno()).st_size - self.monitor.ERROR_SCAN_CHUNK))
+                return f_err.read().decode("utf-8", errors="replace")
+        except OSError:
+            return ""
+
+    def speculate(self):
+        """
+        Launch a duplicate of a speculative task that is running well past its median runtime, if there is capacity.
+        At most one duplicate per attempt.
+        """
+        speculation_time = self.speculation_time()
+        if speculation_time is None or time.time() < speculation_time:
+            return
+        if not self.monitor.has_capacity(self):
+            return
+        self._speculated = True
+        self.duplicate = _SpeculativeRun(self)
+        self.monitor.claim_resources(self, self.duplicate.claim_key)
+        self.duplicate.process = self.monitor.executor.launch(self.duplicate, self.command_list())
+        median = (speculation_time - self.launched_time) / self.monitor.SPECULATIVE_FACTOR
+        self.monitor.error_log(self.name + " : Running over " + "{:.0f}".format(median) + " s median, launched a duplicate.")
+
+    def speculation_time(self):
+        """
+        When a duplicate of the running task is due, or None if it will not get one this attempt.
+        """
+        if not self.speculative or self._speculated or not self.exec_os_command or self.launched_time is None:
+            return None
+        median = self.monitor.median_duration(self)
+        if median is None:
+            return None
+        return self.launched_time + self.monitor.SPECULATIVE_FACTOR * median
+
+    def settle_duplicate(self, return_code):
+        """
+        Keep whichever of the process and its duplicate succeeds first and kill the other.
+        Returns True if the duplicate won and is now the task's process.
+        """
+        duplicate_code = self.duplicate.process.poll()
+        if self.output_pending(self.duplicate, duplicate_code):
+            duplicate_code = None
+
+        if return_code == 0:
+            self.drop_duplicate()
+        elif duplicate_code == 0 and not self.duplicate.has_errors():
+            loser = self.process
+            self.process = self.duplicate.process
+            self.launched_time = self.duplicate.launched_time
+            self.monitor.release_resources(self, self.duplicate.claim_key)
+            self.duplicate = None
+            self.kill_process(loser)
+            # The loser's stderr is not this result's
+            self.reset_error_scan()
+            self.info = "Duplicate finished first."
+            return True
+        elif duplicate_code is not None:
+            # The duplicate failed, carry on with the original
+            self.drop_duplicate()
+        return False
+
+    def drop_duplicate(self):
+        self.kill_process(self.duplicate.process)
+        self.monitor.release_resources(self, self.duplicate.claim_key)
+        self.duplicate = None
+
+    def kill_process(self, process):
+        """
+        Kill a process of this task whose result is not wanted, a timed out attempt or either side of a speculative
+        race, and count the resources it used in the workflow metrics.
+        """
+        if process is None:
+            return
+        _kill(process)
+        self.monitor.record_killed_process(self, process)
+
+    def collect_metrics(self):
+        """
+        Record queue wait, wall time and the process resource usage (cpu times, peak memory) of the run.
+        """
+        metrics = {"wall": time.time() - self.launched_time}
+        if self.ready_time is not None:
+            metrics["queue_wait"] = self.launched_time - self.ready_time
+        metrics.update(getattr(self.process, "resource_metrics", None) or {})
+        self.metrics = metrics
+        self.monitor.record_metrics(self, metrics)
+
+    def update_info(self):
+        # Only update info message if there is at least one message
+        last_entry = self.monitor.last_message(self.name)
+        if last_entry is not self._last_entry:
+            self._last_entry = last_entry
+            self._last_entry_time = time.time()
+        if last_entry:
+            self.info = last_entry[self.monitor._KEY_TIMESTAMP] + ": " + last_entry[self.monitor._KEY_MESSAGE]
+
+        # With captured output, show the latest output line if it is newer than the latest message
+        if self.output_tail:
+            line_time, line = self.output_tail[-1]
+            if not last_entry or line_time > self._last_entry_time:
+                self.info = line
 
     def is_ready(self):
         # check if any items in prereqs and not in completed
@@ -459,18 +1802,1719 @@ class Task(object):
             return self.check_if_skip_fn()
 
     def launch(self):
+        self.metrics = dict()
         self.launched_time = time.time()
+        self._speculated = False
         self.set_status(self.ACTIVE)
 
         self.monitor.active_task_indexs.add(self.index)
-
-        if self.exec_os_command:
-            command_string = self.exec_os_command
-            command_list = command_string.split(" ")
-            # NOTE: http://www.sharats.me/posts/the-ever-useful-and-neat-subprocess-module/
-            # self.process = subprocess.Popen(command_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            with open(self.log_out_path, 'a+') as f_out, open(self.log_err_path, 'a+') as f_err:
-                self.process = subprocess.Popen(command_list, stdout=f_out, stderr=f_err)
-
+        self.monitor.claim_resources(self)
+
+        if self.monitor.is_cacheable(self):
+            # Hashing the inputs may take a while, so the cache is looked up off the monitor thread,
+            # and update starts the command if it misses
+            self.info = "Looking up cached result..."
+            self._cache_lookup = self.monitor.check_pool.submit(self.monitor.restore_cached_result, self)
+            self._cache_lookup.add_done_callback(lambda f: self.monitor.wake())
         else:
-            pass
+            self.start_command()
+
+    def finish_cache_lookup(self):
+        """
+        Once the cache lookup started by launch is over, finish the task if it was restored, else start its command.
+        """
+        if not self._cache_lookup.done():
+            return
+        try:
+            restored = self._cache_lookup.result()
+        except Exception as e:
+            self.monitor.error_log(self.name + " : Cache lookup failed: " + str(e))
+            restored = False
+        self._cache_lookup = None
+        if restored:
+            self.info = "Restored from cache."
+            self.set_status(self.DONE)
+        else:
+            self.info = "..."
+            self.start_command()
+
+    def start_command(self):
+        """
+        Start the task's command, the task being launched and not restored from the cache.
+        """
+        self.launched_time = time.time()
+        if self.exec_os_command:
+            command_list = self.command_list()
+            self.reset_error_scan()
+            self.output_captured = False
+            self.process = self.monitor.executor.launch(self, command_list)
+            self._attempt_err_offset = self._err_offset
+            self.record_launched_process()
+
+        else:
+            pass
+
+    def record_launched_process(self):
+        """
+        Save what identifies the process just launched, so that a restarted monitor can reattach to it.
+        """
+        pid = getattr(self.process, "pid", None)
+        if pid is not None:
+            self.monitor.record_process(self, {
+                "pid": pid,
+                "host": socket.gethostname(),
+                "start_time": process_start_time(pid),
+                "command": command_fingerprint(self.exec_os_command),
+                # As the kernel reports it, an interpreter may have rewritten the command line
+                "cmdline": process_command_fingerprint(pid),
+                "launched_time": self.launched_time,
+                "err_offset": self._err_offset,
+            })
+
+    def command_list(self):
+        """
+        The command split into arguments.
+        """
+        return self.exec_os_command.split(" ")
+
+    def reattach(self):
+        """
+        Find the process launched for this task by an earlier monitor and follow it, if it is still running.
+        The process is only trusted if the host, pid, process start time and command all match what was saved.
+        Returns True if attached.
+        """
+        saved = self.monitor.saved_process(self)
+        if not saved or saved.get("host") != socket.gethostname():
+            return False
+        if saved.get("command") != command_fingerprint(self.exec_os_command):
+            # The task's command has changed since, so whatever is running is not this task
+            return False
+        pid = saved["pid"]
+        start_time = process_start_time(pid)
+        if start_time is None or start_time != saved.get("start_time"):
+            # Gone, or the pid has been reused
+            return False
+        if process_command_fingerprint(pid) != saved.get("cmdline"):
+            return False
+
+        self.process = AttachedProcess(pid, start_time, self.monitor)
+        self.launched_time = saved.get("launched_time") or time.time()
+        self._err_offset = saved.get("err_offset", 0)
+        self._error_found = False
+        self.info = "Reattached to running process " + str(pid)
+        return True
+
+    def reset_error_scan(self):
+        # Stderr from earlier runs has nothing to do with this one, only scan what this run appends
+        try:
+            self._err_offset = os.path.getsize(self.log_err_path)
+        except OSError:
+            self._err_offset = 0
+        self._error_found = False
+
+
+def _descendant_pids(pid):
+    """
+    Pids of all processes below pid, from the parent pids in /proc (linux only, otherwise none are found).
+    """
+    children = collections.defaultdict(list)
+    try:
+        proc_entries = os.listdir("/proc")
+    except OSError:
+        return list()
+    for entry in proc_entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/{}/stat".format(entry), 'rb') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # The command name in parentheses may contain spaces, the fields after it do not
+        children[int(stat[stat.rfind(b")") + 2:].split()[1])].append(int(entry))
+
+    descendants = list()
+    parents = [pid]
+    while parents:
+        below = children.get(parents.pop(), ())
+        descendants.extend(below)
+        parents.extend(below)
+    return descendants
+
+
+# Seconds to wait for a killed child to exit before leaving it to be reaped in the background
+KILL_REAP_SECONDS = 1.0
+
+
+def _kill(process):
+    # Kill a process that may have exited already, and whatever it started, so nothing is left holding its output
+    if process is None or process.returncode is not None:
+        return
+    pid = getattr(process, "pid", None)
+    if pid is not None:
+        for descendant_pid in _descendant_pids(pid):
+            try:
+                os.kill(descendant_pid, signal.SIGKILL)
+            except OSError:
+                pass
+    try:
+        process.kill()
+    except OSError:
+        pass
+
+    if isinstance(process, subprocess.Popen):
+        # Reap it, a killed child that is never waited for stays a zombie until the monitor exits.
+        # Its descendants are not our children, they are reaped by whoever inherits them.
+        try:
+            process.wait(KILL_REAP_SECONDS)
+        except subprocess.TimeoutExpired:
+            # Stuck in an uninterruptible call, wait for it without holding up the monitor
+            threading.Thread(target=process.wait, name="monitor-reap", daemon=True).start()
+
+
+class _SpeculativeRun(object):
+    """
+    What an executor sees of a speculative duplicate of a task: the same command, with its own output files.
+    """
+
+    def __init__(self, task):
+        self.task = task
+        self.name = task.name
+        self.claim_key = (task.index, "duplicate")
+        self.nice = task.nice
+        self.ionice = task.ionice
+        self.log_out_path = os.path.splitext(task.log_out_path)[0] + ".speculative.out"
+        self.log_err_path = os.path.splitext(task.log_err_path)[0] + ".speculative.err"
+        for path in (self.log_out_path, self.log_err_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.launched_time = time.time()
+        self.process = None
+        # Set by an OutputCapture
+        self.output_captured = False
+        self.output_tail = None
+        self.open_output_streams = 0
+        self.output_exit_time = None
+        self._error_found = False
+
+    def reset_error_scan(self):
+        self._error_found = False
+
+    def _match_error_lines(self, data):
+        return self.task._match_error_lines(data)
+
+    def report_error_lines(self, error_lines):
+        if error_lines:
+            self._error_found = True
+
+    def has_errors(self):
+        """
+        True if the duplicate's stderr has any error lines.
+        """
+        if self.output_captured:
+            return self._error_found
+        try:
+            with open(self.log_err_path, 'rb') as f_err:
+                for line in f_err:
+                    if self._match_error_lines(line):
+                        return True
+        except OSError:
+            pass
+        return False
+
+
+class RetryPolicy(object):
+    """
+    When and how soon a failed task is run again.
+
+    A failed attempt is retried until max_attempts have been made, after a backoff of backoff seconds that grows
+    by backoff_factor per attempt up to max_backoff, with up to jitter (a fraction) added at random so that tasks
+    failing together do not all retry at the same moment.
+    Which failures are retried: timeouts if retry_on_timeout, and exits with a code in retry_on_codes, or whose
+    stderr matches any of the regular expressions in retry_on_patterns. If neither is given, any failure is retried.
+    """
+
+    def __init__(self, max_attempts=3, backoff=5.0, backoff_factor=2.0, max_backoff=300.0, jitter=0.1,
+                 retry_on_codes=None, retry_on_patterns=None, retry_on_timeout=True):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_on_codes = set(retry_on_codes) if retry_on_codes is not None else None
+        self.retry_on_patterns = list(retry_on_patterns) if retry_on_patterns is not None else None
+        self.retry_on_timeout = retry_on_timeout
+        self._pattern_regex = re.compile("|".join(self.retry_on_patterns)) if self.retry_on_patterns else None
+
+    def should_retry(self, task, return_code, timed_out=False):
+        if task.attempt >= self.max_attempts:
+            return False
+        if timed_out:
+            return self.retry_on_timeout
+        if self.retry_on_codes is None and self.retry_on_patterns is None:
+            return True
+        if self.retry_on_codes is not None and return_code in self.retry_on_codes:
+            return True
+        if self._pattern_regex is not None and self._pattern_regex.search(task.attempt_stderr()):
+            return True
+        return False
+
+    def delay(self, attempt):
+        """
+        Seconds to wait before running again after the given attempt (counting from 1) failed.
+        """
+        delay = min(self.max_backoff, self.backoff * self.backoff_factor ** (attempt - 1))
+        return delay * (1 + self.jitter * random.random())
+
+
+class LoadThrottle(object):
+    """
+    Paces task launches by the state of the machine, for a Monitor given throttle=LoadThrottle().
+
+    Each pass, the monitor launches at most as many tasks as there are cpus left before the load reaches
+    max_load_per_cpu, none while less than min_available_memory (a fraction of the total) is available, and
+    none beyond max_children running at once if given. While held back it looks again every interval seconds.
+    The load is the lowest number of runnable processes seen over the last window seconds, so momentary spikes
+    are ignored, plus the tasks launched within that window, which the samples may not show yet, so a burst of
+    launches is accounted for at once. The 1 minute load average is used where the number of runnable processes
+    is not available. With nothing of its own running the monitor may always launch one task, so it keeps
+    making progress on a machine kept busy by others.
+    """
+
+    def __init__(self, max_load_per_cpu=1.0, min_available_memory=0.1, max_children=None, interval=0.5, window=1.0):
+        self.max_load_per_cpu = max_load_per_cpu
+        self.min_available_memory = min_available_memory
+        self.max_children = max_children
+        self.interval = interval
+        self.window = window
+        self.cpus = os.cpu_count() or 1
+        self._samples = collections.deque()
+
+    def current_load(self):
+        """
+        Number of processes competing for the cpus, the lowest seen over the last window seconds. None if unknown.
+        """
+        try:
+            with open("/proc/loadavg") as f:
+                fields = f.read().split()
+            # Runnable/total scheduling entities, the one reading this included
+            sample = max(0, int(fields[3].split("/")[0]) - 1)
+        except (OSError, IndexError, ValueError):
+            try:
+                return os.getloadavg()[0]
+            except (AttributeError, OSError):
+                return None
+
+        now = time.time()
+        self._samples.append((now, sample))
+        while self._samples[0][0] < now - self.window:
+            self._samples.popleft()
+        return min(sample for sample_time, sample in self._samples)
+
+    def available_memory(self):
+        """
+        Fraction of memory available for new work, from /proc/meminfo. None if unknown.
+        """
+        meminfo = dict()
+        try:
+            with open("/proc/meminfo") as f:
+                for line in f:
+                    name, _, value = line.partition(":")
+                    meminfo[name] = int(value.split()[0])
+        except (OSError, ValueError, IndexError):
+            return None
+        if "MemAvailable" not in meminfo or not meminfo.get("MemTotal"):
+            return None
+        return meminfo["MemAvailable"] / meminfo["MemTotal"]
+
+    def launch_budget(self, monitor):
+        """
+        How many tasks the monitor may launch now.
+        """
+        running = len(monitor._resource_claims)
+        budget = float("inf")
+        if self.max_children is not None:
+            budget = self.max_children - running
+        load = self.current_load()
+        if load is not None and self.max_load_per_cpu is not None:
+            now = time.time()
+            load += sum(
+                1 for i in monitor.active_task_indexs
+                if monitor.tasks[i].launched_time is not None and now - monitor.tasks[i].launched_time < self.window
+            )
+            budget = min(budget, int(round(self.max_load_per_cpu * self.cpus - load)))
+        available = self.available_memory()
+        if available is not None and self.min_available_memory is not None and available < self.min_available_memory:
+            budget = 0
+        if not running:
+            budget = max(budget, 1)
+        return budget
+
+
+def _init_call_worker(log_environment):
+    # Runs in each new pool worker. A forkserver may have been started before this monitor set its log paths.
+    for key, value in log_environment.items():
+        if value is None:
+            os.environ.pop(key, None)
+        else:
+            os.environ[key] = value
+
+
+def _run_callable(fn, args, kwargs, out_path, err_path):
+    """
+    Runs in a pool worker process. Calls fn with its prints going to the task's .out and .err files, and a
+    traceback on .err if it raises. Returns (return code, return value), the code being what a command would exit with.
+    """
+    with open(out_path, 'a') as f_out, open(err_path, 'a') as f_err:
+        with contextlib.redirect_stdout(f_out), contextlib.redirect_stderr(f_err):
+            try:
+                return 0, fn(*args, **kwargs)
+            except SystemExit as e:
+                code = e.code if isinstance(e.code, int) else 1
+                return code, None
+            except Exception:
+                traceback.print_exc()
+                return 1, None
+
+
+class _CallProcess(object):
+    """
+    Process handle for a call running on the monitor's process pool.
+    """
+
+    def __init__(self, future):
+        self.future = future
+        self.returncode = None
+        self.result = None
+        self.resource_metrics = None
+
+    def poll(self):
+        if self.returncode is None and self.future.done():
+            try:
+                self.returncode, self.result = self.future.result()
+            except concurrent.futures.CancelledError:
+                self.returncode = -signal.SIGKILL
+            except Exception:
+                # The worker died, or the arguments or result could not be pickled
+                self.returncode = 1
+        return self.returncode
+
+    def kill(self):
+        # A call that has started cannot be stopped without stopping its worker, so it is left to finish
+        # and its result is ignored
+        self.future.cancel()
+
+
+class CallableTask(Task):
+    """
+    Task that calls fn(*args, **kwargs) on a pool of worker processes owned by the monitor, instead of running a command.
+    The workers are started once and reused, so a short step costs no interpreter startup or imports.
+
+    fn and its arguments and return value must be picklable, so fn must be a module level function.
+    The workers are started with forkserver (or spawn), which imports the main script again, so a script that
+    makes CallableTasks must run its workflow under if __name__ == "__main__".
+    The call counts as exiting 0 when it returns, and 1 when it raises, with the traceback written to the task's
+    .err file, so statuses, retries and the error scan work as for commands. Prints go to the .out and .err files,
+    and log messages are sent with log_string as from a command. Its return value is kept in result.
+    Without a check_if_done_fn the task is done when the call returns.
+    A call that times out is abandoned, but keeps its worker busy until it returns.
+    """
+
+    def __init__(self, monitor, name, fn, args=(), kwargs=None, check_if_done_fn=None, **task_kwargs):
+        self.fn = fn
+        self.args = tuple(args)
+        self.kwargs = dict(kwargs or {})
+        self.result = None
+        # The command the result cache is keyed by, so the arguments are hashed by value, not by their repr
+        try:
+            arguments = hashlib.sha1(pickle.dumps((self.args, sorted(self.kwargs.items())), protocol=4)).hexdigest()
+        except Exception:
+            # Cannot be pickled, the call will fail anyway
+            arguments = repr((self.args, self.kwargs))
+        description = "{}.{}({})".format(
+            getattr(fn, "__module__", ""), getattr(fn, "__qualname__", repr(fn)), arguments)
+        if check_if_done_fn is None:
+            check_if_done_fn = self.call_returned
+        Task.__init__(self, monitor, name, description, check_if_done_fn, **task_kwargs)
+
+    def call_returned(self):
+        return self.process is not None and self.process.returncode == 0
+
+    def start_command(self):
+        self.launched_time = time.time()
+        self.reset_error_scan()
+        self._attempt_err_offset = self._err_offset
+        self.output_captured = False
+        future = self.monitor.get_call_pool().submit(
+            _run_callable, self.fn, self.args, self.kwargs, self.log_out_path, self.log_err_path)
+        self.process = _CallProcess(future)
+        future.add_done_callback(lambda f: self.monitor.wake())
+
+    def update(self):
+        Task.update(self)
+        if self.process is not None and self.process.returncode == 0:
+            self.result = self.process.result
+
+    def speculate(self):
+        # Calls are never duplicated
+        pass
+
+    def reattach(self):
+        # A call does not outlive the monitor that made it
+        return False
+
+
+def _run_map_batch(fn, command, items):
+    """
+    Runs in a pool worker process. Applies fn, or runs command with {item} replaced, to each item in turn.
+    """
+    results = list()
+    for item in items:
+        if fn is not None:
+            results.append(fn(item))
+        else:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            # Formatted after splitting, so an item with spaces stays one argument
+            command_list = [part.format(item=item) for part in command.split(" ")]
+            subprocess.run(command_list, stdout=sys.stdout, stderr=sys.stderr, check=True)
+            results.append(None)
+    return results
+
+
+class _MapBatch(CallableTask):
+    """
+    One batch of the items of a MapTask.
+    """
+
+    def __init__(self, map_task, start, items, **task_kwargs):
+        self.map_task = map_task
+        self.start = start
+        self.items = items
+        CallableTask.__init__(
+            self, map_task.monitor, "{}[{}:{}]".format(map_task.name, start, start + len(items)),
+            _run_map_batch, (map_task.fn, map_task.command, items), **task_kwargs)
+        # Rather than every item
+        self.exec_os_command = "{} ({} items)".format(map_task.exec_os_command, len(items))
+
+    def set_status(self, status_code):
+        CallableTask.set_status(self, status_code)
+        if status_code != self.ACTIVE and status_code != self.WAIT:
+            # So the map hears about it now rather than at the next heartbeat
+            self.monitor.wake()
+
+
+class MapTask(Task):
+    """
+    Task that applies fn(item), or runs command with "{item}" replaced, for every item returned by items_fn.
+    items_fn is called when the task's prerequisites are complete, so it can list what they produced, for example
+    the files found by search_recursive_file_type.
+
+    The items are run in batches, each a task of its own on the monitor's process pool with up to parallel of them
+    running at once. The first batches have one item each; after that batches are sized from the observed time per
+    item to take about batch_seconds, so the monitor's overhead grows with the number of batches, not of items.
+    resources, timeout and retry apply to each batch. A downstream (reduce) task simply depends on the MapTask,
+    which is done once every batch is, and fails if any batch fails. The return values of fn are in result,
+    in item order. As for CallableTask, the script must run its workflow under if __name__ == "__main__".
+    """
+
+    # Seconds each batch should take once the time per item is known, and the most items in one batch
+    BATCH_SECONDS = 2.0
+    MAX_BATCH = 10000
+
+    def __init__(self, monitor, name, items_fn, fn=None, command=None, check_if_done_fn=None, batch_seconds=None,
+                 parallel=None, resources=None, timeout=12000, retry=None, **task_kwargs):
+        if (fn is None) == (command is None):
+            raise ValueError("MapTask needs one of fn or command.")
+        self.items_fn = items_fn
+        self.fn = fn
+        self.command = command
+        self.batch_seconds = batch_seconds or self.BATCH_SECONDS
+        self.parallel = parallel or monitor.CALL_WORKERS or os.cpu_count() or 1
+        # Passed on to the batches, the map task itself runs nothing
+        self.batch_kwargs = {"resources": resources, "timeout": timeout, "retry": retry}
+        self.items = None
+        self.result = None
+        self.batches = list()
+        self._items_future = None
+        self._next_item = 0
+        self._running = list()
+        self._seconds_per_item = None
+        self._batch_failed = False
+
+        description = "map {} over items".format(command or "{}.{}".format(fn.__module__, fn.__qualname__))
+        Task.__init__(self, monitor, name, description, check_if_done_fn, **task_kwargs)
+
+    def launch(self):
+        self.metrics = dict()
+        self.launched_time = time.time()
+        self.set_status(self.ACTIVE)
+        self.monitor.active_task_indexs.add(self.index)
+
+        self.items = None
+        self.batches = list()
+        self._next_item = 0
+        self._running = list()
+        self._batch_failed = False
+        self.info = "Listing items..."
+        # Listing may walk a large directory tree, keep it off the monitor thread
+        self._items_future = self.monitor.check_pool.submit(lambda: list(self.items_fn()))
+        self._items_future.add_done_callback(lambda f: self.monitor.wake())
+
+    def update(self):
+        if self.status != self.ACTIVE:
+            Task.update(self)
+            return
+
+        if self.items is None:
+            if not self._items_future.done():
+                return
+            try:
+                self.items = self._items_future.result()
+            except Exception as e:
+                self.monitor.error_log(self.name + " : Listing items failed: " + str(e))
+                self.set_status(self.FAILED)
+                return
+
+        still_running = list()
+        for batch in self._running:
+            if batch.status == self.DONE or batch.status == self.SKIP:
+                self._learn_rate(batch)
+            elif batch.status == self.FAILED or batch.status == self.CANCELED:
+                self._batch_failed = True
+            else:
+                still_running.append(batch)
+        self._running = still_running
+
+        while not self._batch_failed and self._next_item < len(self.items) and len(self._running) < self.parallel:
+            self._running.append(self._add_batch())
+
+        n_done = sum(len(batch.items) for batch in self.batches if batch.status == self.DONE)
+        self.info = "{} of {} items done, {} batches".format(n_done, len(self.items), len(self.batches))
+
+        if not self._running and (self._batch_failed or self._next_item >= len(self.items)):
+            if self._batch_failed:
+                self.set_status(self.FAILED)
+            else:
+                self.result = [item_result for batch in self.batches for item_result in (batch.result or ())]
+                self.set_status(self.DONE)
+
+    def _learn_rate(self, batch):
+        wall = batch.metrics.get("wall")
+        if not wall:
+            return
+        seconds_per_item = wall / len(batch.items)
+        if self._seconds_per_item is None:
+            self._seconds_per_item = seconds_per_item
+        else:
+            self._seconds_per_item = (self._seconds_per_item + seconds_per_item) / 2
+
+    def batch_size(self):
+        """
+        Items for the next batch: about batch_seconds of work, but not so many that the other workers sit idle
+        while the last batches run.
+        """
+        remaining = len(self.items) - self._next_item
+        if self._seconds_per_item is None:
+            return 1
+        size = int(self.batch_seconds / max(self._seconds_per_item, 1e-6))
+        size = min(size, self.MAX_BATCH, -(-remaining // self.parallel))
+        return max(1, size)
+
+    def _add_batch(self):
+        start = self._next_item
+        items = self.items[start:start + self.batch_size()]
+        self._next_item += len(items)
+        batch = _MapBatch(self, start, items, **self.batch_kwargs)
+        self.batches.append(batch)
+        self.monitor.register_dynamic_task(batch, self.monitor._priorities[self.index])
+        return batch
+
+
+class AsyncMonitor(Monitor):
+    """
+    Monitor for use inside an asyncio event loop, for example when embedded in a service.
+    Commands are run as asyncio subprocesses whose exits are awaited concurrently, and the check functions
+    run in the loop's default executor, so the loop is never blocked. All tasks must be AsyncTask objects.
+    """
+
+    def __init__(self, *args, **kwargs):
+        Monitor.__init__(self, *args, **kwargs)
+        self._loop = None
+        self._changed = None
+
+    def wake(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._changed.set)
+
+    def watch_fd(self, fd):
+        if self._loop is not None:
+            self._loop.add_reader(fd, self._fd_ready, fd)
+
+    def unwatch_fd(self, fd):
+        if self._loop is not None:
+            self._loop.remove_reader(fd)
+
+    def _fd_ready(self, fd):
+        # Wakes the loop once, as Monitor.watch_fd does
+        self._loop.remove_reader(fd)
+        self._changed.set()
+
+    async def run(self):
+        """
+        Run the workflow until nothing is running or ready to run, and return the final status of each task by name.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._changed = asyncio.Event()
+        self.init_json_log()
+        self.started_time = time.time()
+
+        try:
+            self.load_task_states()
+
+            # Check if tasks are complete.
+            self.poll_json_log()
+            await asyncio.gather(*[
+                task.async_update() for task in self.tasks if task.status == Task.WAIT or task.status == Task.ACTIVE
+            ])
+
+            self.build_task_graph()
+            self.launch_ready_tasks()
+
+            while self.active_task_indexs or self._ready_queue or self._retry_queue:
+                # Woken by any process exit, REFRESH_RATE is only the heartbeat for the check functions
+                try:
+                    await asyncio.wait_for(self._changed.wait(), self.next_wait_timeout())
+                except asyncio.TimeoutError:
+                    pass
+                self._changed.clear()
+                self.poll_json_log()
+
+                await asyncio.gather(*[self.tasks[i].async_update() for i in list(self.active_task_indexs)])
+                self.launch_ready_tasks()
+                self.write_metrics()
+
+        finally:
+            self.write_metrics(force=True)
+            # Joining the writer thread blocks, so do it off the loop
+            await self._loop.run_in_executor(None, self.close_json_log)
+            self._loop = None
+
+        return {task.name: task.status for task in self.tasks}
+
+
+class AsyncTask(Task):
+    """
+    Task launched with asyncio.create_subprocess_exec and awaited by an AsyncMonitor.
+    """
+
+    def __init__(self, *args, **kwargs):
+        Task.__init__(self, *args, **kwargs)
+        self._runner = None
+
+    def launch(self):
+        self.launched_time = time.time()
+        self.set_status(self.ACTIVE)
+
+        self.monitor.active_task_indexs.add(self.index)
+        self.monitor.claim_resources(self)
+
+        if self.exec_os_command:
+            self._runner = asyncio.ensure_future(self._run_process())
+
+    async def _run_process(self):
+        command_list = self.command_list()
+        self.reset_error_scan()
+        self._attempt_err_offset = self._err_offset
+        try:
+            with open(self.log_out_path, 'a+') as f_out, open(self.log_err_path, 'a+') as f_err:
+                self.process = await asyncio.create_subprocess_exec(*command_list, stdout=f_out, stderr=f_err)
+            set_process_priority(self.process.pid, self.nice, self.ionice)
+            self.record_launched_process()
+            await self.process.wait()
+        except OSError as e:
+            self.monitor.error_log(self.name + " : Failed to launch: " + str(e))
+            self.set_status(self.FAILED)
+        finally:
+            self.monitor.wake()
+
+    async def _call(self, fn):
+        # The check functions may be slow (network filesystems), so keep them off the loop
+        return await asyncio.get_running_loop().run_in_executor(None, fn)
+
+    async def async_update(self):
+        """
+        Same as Task.update, with the check functions awaited in the executor.
+        """
+        if self.status != self.ACTIVE and self.status != self.WAIT:
+            return
+
+        if self.is_canceled():
+            self.set_status(self.CANCELED)
+
+        elif await self._call(self.is_skip):
+            self.set_status(self.SKIP)
+
+        elif await self._call(self.check_if_done_fn):
+            self.set_status(self.DONE)
+
+        elif self.status == self.ACTIVE:
+            if self.launched_time is None:
+                self.launched_time = time.time()
+
+            if self.process:
+                # A reattached process only notices its exit when polled, an asyncio one sets returncode itself
+                return_code = self.process.poll() if hasattr(self.process, "poll") else self.process.returncode
+                self.update_from_return_code(return_code)
+                if self.status == self.FAILED and self.process.returncode is None:
+                    # Timed out, do not leave it running unsupervised
+                    self.process.kill()
+
+        self.update_info()
+
+
+class StatusRenderer(object):
+    """
+    Draws the status table of a monitor in the terminal, redrawing only the rows that changed with ANSI cursor addressing.
+    The terminal size is cached and refreshed on SIGWINCH. If there are more tasks than rows, a summary line is shown
+    followed by the active, failed and queued tasks, in that order, as many as fit.
+    When the stream is not a terminal, a plain line is printed for each task status change instead.
+
+    Tasks report their status changes (see task_changed), so a render only looks at the tasks that changed and the
+    rows it shows, not at every task.
+    """
+
+    # Rows above the task rows: name, time, counts, header
+    HEADER_ROWS = 4
+    # Tasks in these statuses are shown first when not all tasks fit
+    SHOW_FIRST = (Task.ACTIVE, Task.FAILED, Task.CANCELED, Task.WAIT)
+
+    def __init__(self, monitor, stream=None):
+        self.monitor = monitor
+        self.stream = stream if stream is not None else sys.stdout
+        self.is_tty = self.stream.isatty()
+        self.size = None
+        self._resized = True
+        self._rows = list()
+        self._old_sigwinch = None
+        # Status of each task as last rendered, the task indexes by status in the order they got it,
+        # and the indexes changed since the last render
+        self._statuses = dict()
+        self._by_status = collections.defaultdict(dict)
+        self._changed = set()
+        self._synced = False
+
+    def task_changed(self, index):
+        """
+        Note that the status of the task at index may have changed, for the next render.
+        """
+        self._changed.add(index)
+
+    def _take_changes(self):
+        """
+        Bring the per status indexes up to date and return the tasks whose status changed, in index order.
+        """
+        tasks = self.monitor.tasks
+        if not self._synced:
+            # Statuses restored from the json log were set directly, take every task once
+            self._synced = True
+            self._changed.update(range(len(tasks)))
+        changed, self._changed = self._changed, set()
+
+        changed_tasks = list()
+        for index in sorted(changed):
+            task = tasks[index]
+            old_status = self._statuses.get(index)
+            if old_status == task.status:
+                continue
+            if old_status is not None:
+                del self._by_status[old_status][index]
+            self._by_status[task.status][index] = None
+            self._statuses[index] = task.status
+            changed_tasks.append(task)
+        return changed_tasks
+
+    def install(self):
+        if not self.is_tty or not hasattr(signal, "SIGWINCH"):
+            return
+        if threading.current_thread() is not threading.main_thread():
+            return
+        self._old_sigwinch = signal.signal(signal.SIGWINCH, self._on_resize)
+
+    def uninstall(self):
+        if self._old_sigwinch is not None:
+            signal.signal(signal.SIGWINCH, self._old_sigwinch)
+            self._old_sigwinch = None
+
+    def _on_resize(self, signum, frame):
+        self._resized = True
+
+    def render(self):
+        if self.is_tty:
+            self._render_screen()
+        else:
+            self._render_changes()
+
+    def _render_changes(self):
+        changed_tasks = self._take_changes()
+        if not changed_tasks:
+            return
+        timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        for task in changed_tasks:
+            print(timestamp + " " + self.monitor.TEMPLATE.format(task.status, task.name, task.info), file=self.stream)
+        self.stream.flush()
+
+    def _build_rows(self, w_height):
+        self._take_changes()
+        tasks = self.monitor.tasks
+        counts = sorted((status, len(indexes)) for status, indexes in self._by_status.items() if indexes)
+        rows = [
+            self.monitor.name.upper(),
+            datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            "  ".join("{} {}".format(status, count) for status, count in counts),
+            self.monitor.HEADER,
+        ]
+
+        task_rows = max(w_height - self.HEADER_ROWS, 1)
+        if len(tasks) > task_rows:
+            # Summarised view, the most interesting tasks first and a count of what did not fit
+            statuses = list(self.SHOW_FIRST) + sorted(set(self._by_status) - set(self.SHOW_FIRST))
+            shown = itertools.islice(
+                itertools.chain.from_iterable(self._by_status.get(status, ()) for status in statuses), task_rows - 1)
+            hidden = len(tasks) - (task_rows - 1)
+            tasks = [tasks[index] for index in shown]
+        else:
+            hidden = 0
+
+        for task in tasks:
+            rows.append(self.monitor.TEMPLATE.format(task.status, task.name, task.info))
+        if hidden > 0:
+            rows.append("... {} more tasks".format(hidden))
+        return rows
+
+    def _render_screen(self):
+        out = list()
+        if self._resized or self.size is None:
+            self._resized = False
+            self.size = shutil.get_terminal_size()
+            # Clear the screen, every row is redrawn
+            out.append("\x1b[2J")
+            self._rows = list()
+        w_width, w_height = self.size
+
+        rows = self._build_rows(w_height)
+        rows = [(text[:w_width-2] + '..') if len(text) > w_width else text for text in rows]
+        for i, text in enumerate(rows):
+            if i >= len(self._rows) or self._rows[i] != text:
+                out.append("\x1b[{};1H\x1b[2K{}".format(i + 1, text))
+        for i in range(len(rows), len(self._rows)):
+            out.append("\x1b[{};1H\x1b[2K".format(i + 1))
+        self._rows = rows
+
+        # Park the cursor below the table
+        out.append("\x1b[{};1H".format(min(len(rows) + 1, w_height)))
+        self.stream.write("".join(out))
+        self.stream.flush()
+
+
+def command_fingerprint(command_string):
+    return hashlib.sha256(command_string.encode("utf-8")).hexdigest()
+
+
+def process_start_time(pid):
+    """
+    Start time of the process in clock ticks since boot, from /proc. None if there is no such (live) process.
+    Together with the pid this identifies a process even if the pid is later reused.
+    """
+    try:
+        with open("/proc/{}/stat".format(pid), 'rb') as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # The command name in parentheses may contain spaces, the fields after it do not
+    fields = stat[stat.rfind(b")") + 2:].split()
+    if fields[0] in (b"Z", b"X"):
+        # Exited, only waiting to be reaped
+        return None
+    return fields[19].decode("ascii")
+
+
+def process_command_fingerprint(pid):
+    try:
+        with open("/proc/{}/cmdline".format(pid), 'rb') as f:
+            argv = f.read().rstrip(b"\0").split(b"\0")
+    except OSError:
+        return None
+    return command_fingerprint(" ".join(arg.decode("utf-8", errors="replace") for arg in argv))
+
+
+class AttachedProcess(object):
+    """
+    Process handle for a task process started by an earlier monitor and still running.
+    It is not a child of this monitor, so its exit is noticed through a pidfd watched by the monitor (or /proc),
+    and its exit code is unknown: poll returns 0 once it has exited, with exit_code_known False, and the task
+    only succeeds if its error scan is clean and its check_if_done_fn passes (see Task.update_from_return_code).
+    """
+
+    exit_code_known = False
+
+    def __init__(self, pid, start_time, monitor=None):
+        self.pid = pid
+        self.start_time = start_time
+        self.monitor = monitor
+        self.returncode = None
+        self.resource_metrics = None
+        self.pidfd = None
+        if hasattr(os, "pidfd_open"):
+            try:
+                self.pidfd = os.pidfd_open(pid)
+            except OSError:
+                pass
+        if self.pidfd is not None and monitor is not None:
+            monitor.watch_fd(self.pidfd)
+
+    def poll(self):
+        if self.returncode is None:
+            if self.pidfd is not None:
+                exited = bool(select.select([self.pidfd], [], [], 0)[0])
+            else:
+                exited = process_start_time(self.pid) != self.start_time
+            if exited:
+                self.returncode = 0
+                self.close()
+        return self.returncode
+
+    def close(self):
+        if self.pidfd is None:
+            return
+        if self.monitor is not None:
+            self.monitor.unwatch_fd(self.pidfd)
+        os.close(self.pidfd)
+        self.pidfd = None
+
+    def kill(self):
+        if self.poll() is None:
+            os.kill(self.pid, signal.SIGKILL)
+
+
+# ioprio_set system call numbers by machine, the C library has no wrapper for it
+_IOPRIO_SET_SYSCALLS = {
+    "x86_64": 251,
+    "i386": 289,
+    "i686": 289,
+    "aarch64": 30,
+    "riscv64": 30,
+    "armv7l": 314,
+    "ppc64le": 273,
+    "s390x": 282,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _ioprio_set():
+    # The ioprio_set system call, or None where its number is not known. ctypes is only loaded when first needed.
+    import ctypes
+    import platform
+
+    syscall_number = _IOPRIO_SET_SYSCALLS.get(platform.machine())
+    if syscall_number is None:
+        return None
+    return functools.partial(ctypes.CDLL(None, use_errno=True).syscall, syscall_number)
+
+
+def set_process_priority(pid, nice=None, ionice=None):
+    """
+    Lower the priority of a process just started for a task. nice is added to its niceness as by the nice utility.
+    ionice is the io scheduling class (1 realtime, 2 best effort, 3 idle) or (class, level), as by the ionice utility;
+    it is ignored where the system call number is not known.
+    Set from the monitor once the process runs the command, as running python between fork and exec is unsafe with
+    the monitor's threads, and not through those utilities, so its command line stays the task's own
+    (see Task.reattach). A process that has already exited, or a priority that is not permitted, is left as it is.
+    """
+    if nice:
+        try:
+            os.setpriority(os.PRIO_PROCESS, pid, min(os.getpriority(os.PRIO_PROCESS, pid) + nice, 19))
+        except OSError:
+            pass
+    if ionice is not None:
+        ioprio_set = _ioprio_set()
+        if ioprio_set is not None:
+            io_class, io_level = ionice if isinstance(ionice, (tuple, list)) else (ionice, None)
+            if io_level is None:
+                # As ionice, level 4 for the classes that have levels
+                io_level = 4 if io_class in (1, 2) else 0
+            # IOPRIO_WHO_PROCESS, for that process
+            ioprio_set(1, pid, (io_class << 13) | io_level)
+
+
+def rusage_metrics(rusage):
+    return {
+        "user_cpu": rusage.ru_utime,
+        "system_cpu": rusage.ru_stime,
+        # Kilobytes on linux
+        "max_rss_kb": rusage.ru_maxrss,
+    }
+
+
+class RusagePopen(subprocess.Popen):
+    """
+    Popen that reaps its child with os.wait4, keeping the child's resource usage in resource_metrics.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.resource_metrics = None
+        # Check functions may poll from pool threads, only one thread may reap
+        self._reap_lock = threading.Lock()
+        subprocess.Popen.__init__(self, *args, **kwargs)
+
+    def poll(self):
+        with self._reap_lock:
+            if self.returncode is None and hasattr(os, "wait4"):
+                try:
+                    pid, status, rusage = os.wait4(self.pid, os.WNOHANG)
+                except ChildProcessError:
+                    # Already reaped by someone else
+                    return subprocess.Popen.poll(self)
+                if pid == self.pid:
+                    self.resource_metrics = rusage_metrics(rusage)
+                    self.returncode = os.waitstatus_to_exitcode(status)
+        return subprocess.Popen.poll(self)
+
+    def wait(self, timeout=None):
+        # Popen.wait reaps with waitpid, which would lose the resource usage
+        if not hasattr(os, "wait4"):
+            return subprocess.Popen.wait(self, timeout)
+        if timeout is None:
+            with self._reap_lock:
+                if self.returncode is None:
+                    try:
+                        pid, status, rusage = os.wait4(self.pid, 0)
+                    except ChildProcessError:
+                        return subprocess.Popen.wait(self)
+                    self.resource_metrics = rusage_metrics(rusage)
+                    self.returncode = os.waitstatus_to_exitcode(status)
+            return self.returncode
+
+        end_time = time.monotonic() + timeout
+        delay = 0.0005
+        while self.poll() is None:
+            remaining = end_time - time.monotonic()
+            if remaining <= 0:
+                raise subprocess.TimeoutExpired(self.args, timeout)
+            time.sleep(min(delay, remaining, 0.05))
+            delay *= 2
+        return self.returncode
+
+
+class LocalExecutor(object):
+    """
+    Runs task commands on this machine with subprocess.Popen. This is the default executor of a Monitor.
+
+    An executor has start(monitor), launch(task, command_list) and close().
+    launch returns a process handle with poll() and kill(), like a Popen object.
+    """
+
+    def start(self, monitor):
+        self.monitor = monitor
+
+    def launch(self, task, command_list):
+        if self.monitor.output_capture:
+            process = RusagePopen(command_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            set_process_priority(process.pid, task.nice, task.ionice)
+            self.monitor.output_capture.attach(task, process)
+            return process
+
+        # NOTE: http://www.sharats.me/posts/the-ever-useful-and-neat-subprocess-module/
+        # self.process = subprocess.Popen(command_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        with open(task.log_out_path, 'a+') as f_out, open(task.log_err_path, 'a+') as f_err:
+            process = RusagePopen(command_list, stdout=f_out, stderr=f_err)
+        set_process_priority(process.pid, task.nice, task.ionice)
+        return process
+
+    def close(self):
+        pass
+
+
+class RotatingLog(object):
+    """
+    Log file capped at max_bytes. When full, it is moved to path.1 (path.1 to path.2 and so on, keeping backups),
+    with the moved files gzip compressed if compress is set.
+    """
+
+    def __init__(self, path, max_bytes, backups, compress):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.compress = compress
+        self.f = open(path, 'ab')
+        self.size = self.f.tell()
+
+    def _backup_path(self, i):
+        return "{}.{}{}".format(self.path, i, ".gz" if self.compress else "")
+
+    def rotate(self):
+        self.f.close()
+        if self.backups:
+            for i in range(self.backups - 1, 0, -1):
+                if os.path.exists(self._backup_path(i)):
+                    os.replace(self._backup_path(i), self._backup_path(i + 1))
+            if self.compress:
+                with open(self.path, 'rb') as f_in, gzip.open(self._backup_path(1), 'wb') as f_gz:
+                    shutil.copyfileobj(f_in, f_gz)
+            else:
+                os.replace(self.path, self._backup_path(1))
+        self.f = open(self.path, 'wb')
+        self.size = 0
+
+    def write(self, data):
+        if self.size and self.size + len(data) > self.max_bytes:
+            self.rotate()
+        self.f.write(data)
+        self.f.flush()
+        self.size += len(data)
+
+    def close(self):
+        self.f.close()
+
+
+class _CapturedStream(object):
+    def __init__(self, task, log, is_stderr):
+        self.task = task
+        self.log = log
+        self.is_stderr = is_stderr
+        self.partial = b""
+
+
+class OutputCapture(object):
+    """
+    Reads the stdout and stderr of local task commands through pipes, on one thread for all tasks.
+    Output is written to the task's .out and .err files, which are rotated when a run starts and whenever they
+    reach max_bytes, keeping backups older files (gzip compressed if compress is set). The last lines of output
+    are kept in the task's output_tail for display, and stderr is scanned for errors as it arrives.
+    So disk use is bounded by (backups + 1) * max_bytes per file, and memory by lines per task.
+    Error lines and closed pipes are handed to the monitor thread, which applies them to the tasks with deliver.
+    """
+
+    # A line longer than this is split, so a tool that never writes a newline cannot grow memory
+    MAX_LINE = 1 << 16
+    # Seconds to wait for the pipes of an exited process to close, after which they are read no further
+    EXIT_GRACE = 2.0
+
+    def __init__(self, lines=20, max_bytes=10 << 20, backups=3, compress=True):
+        self.lines = lines
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.compress = compress
+        self.monitor = None
+        self._selector = None
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._attach_queue = collections.deque()
+        self._detach_queue = collections.deque()
+        # (task, error lines, pipe closed) for the monitor thread
+        self._events = collections.deque()
+        self._stop = False
+        self._thread = None
+
+    def start(self, monitor):
+        self.monitor = monitor
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
+        self._thread = threading.Thread(target=self._serve, name="monitor-output-capture", daemon=True)
+        self._thread.start()
+
+    def attach(self, task, process):
+        """
+        Start capturing the output pipes of a task's process. Called from the monitor thread.
+        """
+        task.output_captured = True
+        task.output_tail = collections.deque(maxlen=self.lines)
+        task.open_output_streams = 2
+        task.output_exit_time = None
+        task.output_detached = False
+        # Each run starts with fresh files, the previous run's output becomes the first backup
+        out_log = RotatingLog(task.log_out_path, self.max_bytes, self.backups, self.compress)
+        err_log = RotatingLog(task.log_err_path, self.max_bytes, self.backups, self.compress)
+        for log in (out_log, err_log):
+            if log.size:
+                log.rotate()
+        task.reset_error_scan()
+        self._attach_queue.append((process.stdout, _CapturedStream(task, out_log, False)))
+        self._attach_queue.append((process.stderr, _CapturedStream(task, err_log, True)))
+        self._wakeup_w.send(b"\0")
+
+    def detach(self, task):
+        """
+        Stop capturing the output of a task whose process has exited, taking only what its pipes hold now.
+        Called from the monitor thread, once per run.
+        """
+        if task.output_detached:
+            return
+        task.output_detached = True
+        self._detach_queue.append(task)
+        self._wakeup_w.send(b"\0")
+
+    def deliver(self):
+        """
+        Apply the error lines and closed pipes seen by the capture thread to their tasks. Called from the monitor thread.
+        """
+        while self._events:
+            task, error_lines, closed = self._events.popleft()
+            task.report_error_lines(error_lines)
+            if closed:
+                task.open_output_streams -= 1
+
+    def close(self):
+        if self._thread is None:
+            return
+        self._stop = True
+        self._wakeup_w.send(b"\0")
+        self._thread.join()
+        self._thread = None
+        for key in list(self._selector.get_map().values()):
+            if key.data is not None:
+                self._finish(key.fileobj, key.data)
+        self._selector.close()
+
+    def _serve(self):
+        while not self._stop:
+            for key, _ in self._selector.select():
+                if key.fileobj is self._wakeup_r:
+                    self._wakeup_r.recv(4096)
+                    while self._attach_queue:
+                        pipe, stream = self._attach_queue.popleft()
+                        os.set_blocking(pipe.fileno(), False)
+                        self._selector.register(pipe, selectors.EVENT_READ, stream)
+                    while self._detach_queue:
+                        self._detach(self._detach_queue.popleft())
+                else:
+                    self._read(key.fileobj, key.data)
+
+    def _detach(self, task):
+        for key in list(self._selector.get_map().values()):
+            if key.data is None or key.data.task is not task:
+                continue
+            # Whatever still holds the pipe open is not waited for
+            while self._read(key.fileobj, key.data):
+                pass
+            if key.fileobj in self._selector.get_map():
+                self._finish(key.fileobj, key.data)
+
+    def _read(self, pipe, stream):
+        """
+        Read once from the pipe. Returns False if there was nothing to read, or the pipe closed.
+        """
+        try:
+            data = os.read(pipe.fileno(), 65536)
+        except BlockingIOError:
+            return False
+        if not data:
+            self._finish(pipe, stream)
+            return False
+
+        stream.log.write(data)
+        data = stream.partial + data
+        end = data.rfind(b"\n") + 1
+        if not end and len(data) > self.MAX_LINE:
+            end = len(data)
+        stream.partial = data[end:]
+        self._take_lines(stream, data[:end])
+        return True
+
+    def _take_lines(self, stream, data):
+        if not data:
+            return
+        now = time.time()
+        for line in data.splitlines()[-self.lines:]:
+            stream.task.output_tail.append((now, line.decode("utf-8", errors="replace")))
+        if stream.is_stderr:
+            error_lines = stream.task._match_error_lines(data)
+            if error_lines:
+                self._events.append((stream.task, error_lines, False))
+
+    def _finish(self, pipe, stream):
+        self._selector.unregister(pipe)
+        pipe.close()
+        self._take_lines(stream, stream.partial)
+        stream.partial = b""
+        stream.log.close()
+        self._events.append((stream.task, None, True))
+        self.monitor.wake()
+
+
+def _parse_address(address):
+    """
+    "host:port" is a TCP address, anything else is the path of a UNIX socket.
+    """
+    host, _, port = address.rpartition(":")
+    if host and port.isdigit():
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, address
+
+
+class _JsonLineSocket(object):
+    """
+    A socket carrying one json message per line. Sending is safe from any thread.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self._buffer = b""
+        self._send_lock = threading.Lock()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, message):
+        with self._send_lock:
+            self.sock.sendall((json.dumps(message) + "\n").encode("utf-8"))
+
+    def receive(self):
+        """
+        Read what is available and return the complete messages, or None if the other end has closed.
+        """
+        data = self.sock.recv(65536)
+        if not data:
+            return None
+        self._buffer += data
+        lines = self._buffer.split(b"\n")
+        self._buffer = lines.pop()
+        return [json.loads(line.decode("utf-8")) for line in lines if line]
+
+    def close(self):
+        self.sock.close()
+
+
+class RemoteProcess(object):
+    """
+    Process handle for a command running on a remote worker, set by the RemoteExecutor thread.
+    """
+
+    def __init__(self, executor, job_id):
+        self.executor = executor
+        self.job_id = job_id
+        self.returncode = None
+        self.resource_metrics = None
+
+    def poll(self):
+        return self.returncode
+
+    def kill(self):
+        self.executor.kill(self.job_id)
+
+
+class _RemoteWorker(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.name = None
+        self.slots = 0
+        self.job_ids = set()
+        self.last_seen = time.time()
+
+
+class RemoteExecutor(object):
+    """
+    Hands task commands to worker agents (see run_worker) connected over a TCP ("host:port") or UNIX socket address.
+    Workers say how many slots they have, are sent commands as slots free up, send back log messages and exit codes,
+    and heartbeat. A worker that misses heartbeats for HEARTBEAT_TIMEOUT seconds is dropped and its commands get
+    LOST_RETURN_CODE, which fails the task.
+
+    Workers write the task's .out/.err files themselves, so the logging directory must be on a shared filesystem.
+
+    The address is bound when the executor is made, so workers can be started (see spawn_local_workers to try one out
+    on a single machine) before the monitor runs. They are queued until it does.
+    """
+
+    HEARTBEAT_INTERVAL = 2
+    HEARTBEAT_TIMEOUT = 10
+    LOST_RETURN_CODE = -255
+
+    def __init__(self, address):
+        self.family, self.bind_address = _parse_address(address)
+        self.address = address
+        self.monitor = None
+
+        self._lock = threading.Lock()
+        self._pending = collections.deque()
+        self._jobs = dict()
+        self._job_ids = itertools.count()
+        self._workers = dict()
+
+        if self.family == socket.AF_UNIX and os.path.exists(self.bind_address):
+            os.unlink(self.bind_address)
+        self._listener = socket.socket(self.family, socket.SOCK_STREAM)
+        if self.family == socket.AF_INET:
+            self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(self.bind_address)
+        self._listener.listen()
+        if self.family == socket.AF_INET:
+            # Report the real port when bound to port 0
+            self.address = "{}:{}".format(self.bind_address[0], self._listener.getsockname()[1])
+
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._selector.register(self._listener, selectors.EVENT_READ)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
+        self._stop = False
+        self._thread = None
+
+    def start(self, monitor):
+        self.monitor = monitor
+        self._thread = threading.Thread(target=self._serve, name="monitor-remote-executor", daemon=True)
+        self._thread.start()
+
+    def launch(self, task, command_list):
+        process = RemoteProcess(self, next(self._job_ids))
+        message = {
+            "type": "run",
+            "id": process.job_id,
+            "task": task.name,
+            "command": command_list,
+            "out": task.log_out_path,
+            "err": task.log_err_path,
+            "nice": task.nice,
+            "ionice": task.ionice,
+        }
+        with self._lock:
+            self._jobs[process.job_id] = process
+            self._pending.append(message)
+        self._wakeup_w.send(b"\0")
+        return process
+
+    def kill(self, job_id):
+        with self._lock:
+            for message in self._pending:
+                if message["id"] == job_id:
+                    # Not sent to a worker yet, just never send it
+                    self._pending.remove(message)
+                    self._finish(job_id, -signal.SIGKILL)
+                    return
+            for worker in self._workers.values():
+                if job_id in worker.job_ids:
+                    worker.connection.send({"type": "kill", "id": job_id})
+                    return
+
+    def close(self):
+        if self._listener is None:
+            return
+        if self._thread is not None:
+            self._stop = True
+            self._wakeup_w.send(b"\0")
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            for worker in list(self._workers.values()):
+                try:
+                    worker.connection.send({"type": "stop"})
+                except OSError:
+                    pass
+                worker.connection.close()
+            self._workers.clear()
+        self._selector.close()
+        self._listener.close()
+        self._listener = None
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+        if self.family == socket.AF_UNIX and os.path.exists(self.bind_address):
+            os.unlink(self.bind_address)
+
+    def _finish(self, job_id, return_code, resource_metrics=None):
+        process = self._jobs.pop(job_id, None)
+        if process is not None:
+            process.resource_metrics = resource_metrics
+            process.returncode = return_code
+            self.monitor.wake()
+
+    def _serve(self):
+        while not self._stop:
+            for key, _ in self._selector.select(self.HEARTBEAT_INTERVAL):
+                if key.fileobj is self._listener:
+                    sock, _ = self._listener.accept()
+                    connection = _JsonLineSocket(sock)
+                    with self._lock:
+                        self._workers[sock.fileno()] = _RemoteWorker(connection)
+                    self._selector.register(connection, selectors.EVENT_READ)
+                elif key.fileobj is self._wakeup_r:
+                    self._wakeup_r.recv(4096)
+                else:
+                    self._receive(key.fileobj)
+
+            with self._lock:
+                now = time.time()
+                for worker in list(self._workers.values()):
+                    if now - worker.last_seen > self.HEARTBEAT_TIMEOUT:
+                        self.monitor.error_log("Remote worker lost: " + str(worker.name))
+                        self._drop(worker)
+                self._dispatch()
+
+    def _receive(self, connection):
+        try:
+            messages = connection.receive()
+        except (OSError, ValueError):
+            messages = None
+        with self._lock:
+            worker = self._workers.get(connection.fileno())
+            if worker is None:
+                return
+            if messages is None:
+                self.monitor.error_log("Remote worker disconnected: " + str(worker.name))
+                self._drop(worker)
+                return
+            worker.last_seen = time.time()
+            for message in messages:
+                if message["type"] == "hello":
+                    worker.name = message["name"]
+                    worker.slots = message["slots"]
+                elif message["type"] == "log":
+                    self.monitor.apply_log_record(message["record"])
+                elif message["type"] == "exit":
+                    worker.job_ids.discard(message["id"])
+                    self._finish(message["id"], message["code"], message.get("metrics"))
+
+    def _drop(self, worker):
+        # Called with the lock held
+        self._selector.unregister(worker.connection)
+        del self._workers[worker.connection.fileno()]
+        worker.connection.close()
+        for job_id in worker.job_ids:
+            self._finish(job_id, self.LOST_RETURN_CODE)
+
+    def _dispatch(self):
+        # Called with the lock held. Hand pending commands to the workers with the most free slots first.
+        while self._pending:
+            free_workers = [worker for worker in self._workers.values() if len(worker.job_ids) < worker.slots]
+            if not free_workers:
+                return
+            worker = max(free_workers, key=lambda w: w.slots - len(w.job_ids))
+            message = self._pending.popleft()
+            worker.job_ids.add(message["id"])
+            try:
+                worker.connection.send(message)
+            except OSError:
+                self._drop(worker)
+
+
+def run_worker(address, slots=None, name=None, connect_timeout=30.0):
+    """
+    Worker agent for a RemoteExecutor. Connects to the monitor, runs the commands it is sent (up to slots at a time),
+    and sends back log messages, exit codes and heartbeats until the monitor closes the connection.
+    Messages logged with Monitor.log_string by the commands go to a local journal that the worker forwards.
+    Connecting is retried for connect_timeout seconds, so a worker may be started before its RemoteExecutor.
+    """
+    if slots is None:
+        slots = os.cpu_count() or 1
+    if name is None:
+        name = "{}:{}".format(socket.gethostname(), os.getpid())
+
+    family, connect_address = _parse_address(address)
+    give_up_time = time.time() + connect_timeout
+    while True:
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.connect(connect_address)
+            break
+        except (ConnectionRefusedError, FileNotFoundError):
+            sock.close()
+            if time.time() > give_up_time:
+                raise
+            time.sleep(0.2)
+    connection = _JsonLineSocket(sock)
+    connection.send({"type": "hello", "name": name, "slots": slots})
+
+    journal_dir = tempfile.mkdtemp(prefix="monitor_worker_")
+    # job id -> [process, journal path, journal offset]
+    jobs = dict()
+    last_heartbeat = time.time()
+
+    def forward_journal(job):
+        try:
+            with open(job[1], 'rb') as f_journal:
+                f_journal.seek(job[2])
+                data = f_journal.read()
+        except FileNotFoundError:
+            return
+        end = data.rfind(b"\n") + 1
+        job[2] += end
+        for line in data[:end].splitlines():
+            try:
+                connection.send({"type": "log", "record": json.loads(line.decode("utf-8"))})
+            except ValueError:
+                pass
+
+    selector = selectors.DefaultSelector()
+    selector.register(connection, selectors.EVENT_READ)
+    try:
+        while True:
+            if selector.select(0.1):
+                messages = connection.receive()
+                if messages is None:
+                    break
+                for message in messages:
+                    if message["type"] == "run":
+                        journal_path = os.path.join(journal_dir, str(message["id"]) + ".journal")
+                        env = dict(os.environ)
+                        env[Monitor.LOG_JOURNAL] = journal_path
+                        # Messages are relayed from the journal, never sent to a socket on this machine
+                        env.pop(Monitor.LOG_SOCKET, None)
+                        try:
+                            with open(message["out"], 'a+') as f_out, open(message["err"], 'a+') as f_err:
+                                process = RusagePopen(message["command"], stdout=f_out, stderr=f_err, env=env)
+                            set_process_priority(process.pid, message.get("nice"), message.get("ionice"))
+                        except OSError as e:
+                            print(message["task"] + " : Failed to launch: " + str(e), file=sys.stderr)
+                            connection.send({"type": "exit", "id": message["id"], "code": 127})
+                            continue
+                        jobs[message["id"]] = [process, journal_path, 0]
+                    elif message["type"] == "kill":
+                        if message["id"] in jobs:
+                            jobs[message["id"]][0].kill()
+                    elif message["type"] == "stop":
+                        return
+
+            for job_id, job in list(jobs.items()):
+                return_code = job[0].poll()
+                forward_journal(job)
+                if return_code is not None:
+                    connection.send({"type": "exit", "id": job_id, "code": return_code, "metrics": job[0].resource_metrics})
+                    del jobs[job_id]
+
+            if time.time() - last_heartbeat > RemoteExecutor.HEARTBEAT_INTERVAL:
+                connection.send({"type": "heartbeat"})
+                last_heartbeat = time.time()
+    finally:
+        for job in jobs.values():
+            job[0].kill()
+        selector.close()
+        connection.close()
+
+
+def spawn_local_workers(address, count, slots=1):
+    """
+    Start worker agents as local processes, standing in for other machines when trying out a RemoteExecutor.
+    """
+    return [
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), "--worker", address, "--slots", str(slots)])
+        for _ in range(count)
+    ]
+
+
+if __name__ == "__main__":
+
+    # Parse command line args.
+    cmdLineParser = argparse.ArgumentParser("Task Monitor")
+    cmdLineParser.add_argument(
+        "--worker",
+        action="store",
+        type=str,
+        dest="worker_address",
+        required=True,
+        help="Run as a remote worker agent for the monitor at this address, host:port or a UNIX socket path")
+    cmdLineParser.add_argument(
+        "--slots",
+        action="store",
+        type=int,
+        dest="slots",
+        default=None,
+        help="How many commands this worker runs at a time, defaults to the cpu count")
+    args = cmdLineParser.parse_args()
+
+    run_worker(args.worker_address, args.slots)
@@ -0,0 +1,318 @@
+"""
+Benchmark of the Monitor's own overhead on synthetic workflows.
+
+Builds workflows of no-op or sleep tasks in a few DAG shapes, runs them, and reports the scheduler cpu per tick,
+the latency from a prerequisite finishing to its dependent launching, the json log I/O and the cpu of the thread
+writing it, and the makespan against the ideal makespan of the same DAG. Results are written as json, so runs can be
+compared to catch regressions in Monitor.run, Task.update and the logging path.
+
+It also measures the import time of monitor_client, which every task command that logs pays once, and exits with
+an error if it is over budget. With --workers the tasks run through a RemoteExecutor on that many local worker
+processes, which checks the remote path end to end; any task that does not finish is an error.
+
+    python monitor_bench.py --shapes chain fanout layered --sizes 10 100 1000 --output bench.json
+    python monitor_bench.py --shapes layered --sizes 100 --workers 2
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import functools
+import subprocess
+
+from monitor import Monitor, Task, StatusRenderer, RemoteExecutor, spawn_local_workers
+
+
+def chain_edges(n_tasks, rng):
+    """
+    Each task depends on the one before it.
+    """
+    return [[i - 1] if i else [] for i in range(n_tasks)]
+
+
+def fanout_edges(n_tasks, rng):
+    """
+    One root, every middle task depends on the root, and one sink depends on all of the middle tasks.
+    """
+    if n_tasks < 3:
+        return chain_edges(n_tasks, rng)
+    middle = list(range(1, n_tasks - 1))
+    return [[]] + [[0] for _ in middle] + [middle]
+
+
+def layered_edges(n_tasks, rng, width=None, edge_probability=0.2):
+    """
+    Random layered DAG, each task depends on a random subset (at least one) of the tasks in the layer above.
+    """
+    if width is None:
+        width = max(1, int(n_tasks ** 0.5))
+    edges = list()
+    previous_layer = list()
+    layer = list()
+    for i in range(n_tasks):
+        if previous_layer:
+            prereqs = [p for p in previous_layer if rng.random() < edge_probability]
+            edges.append(prereqs or [rng.choice(previous_layer)])
+        else:
+            edges.append([])
+        layer.append(i)
+        if len(layer) == width:
+            previous_layer, layer = layer, list()
+    return edges
+
+
+SHAPES = {
+    "chain": chain_edges,
+    "fanout": fanout_edges,
+    "layered": layered_edges,
+}
+
+
+# Seconds importing monitor_client may take in a fresh interpreter
+IMPORT_BUDGET_SECONDS = 0.015
+
+
+def import_seconds(module, runs=5):
+    """
+    Seconds a fresh interpreter spends importing module, the best of runs, from python's own -X importtime report.
+    """
+    bench_dir = os.path.dirname(os.path.abspath(__file__))
+    best = None
+    for _ in range(runs):
+        completed = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import " + module],
+            cwd=bench_dir, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+        for line in completed.stderr.splitlines():
+            # import time: self [us] | cumulative | imported package
+            fields = line.split("|")
+            if len(fields) == 3 and fields[2].strip() == module:
+                seconds = int(fields[1]) / 1e6
+                best = seconds if best is None else min(best, seconds)
+    return best
+
+
+# Each task's command, writing the time it exits, so launch latency is measured from the real exit rather than from
+# when the monitor noticed it. bash 5 has the time built in, so nothing is forked to take it.
+EXIT_STAMP_SCRIPT = """#!/bin/bash
+if [ "$2" != "0" ]; then sleep "$2"; fi
+echo "$EPOCHREALTIME" > "$1"
+"""
+
+
+def _read_exit_time(path):
+    try:
+        with open(path) as f:
+            return float(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def _exited_ok(task):
+    # Done as soon as the monitor has seen the process exit cleanly, so nothing but the monitor adds latency
+    return task.process is not None and task.process.returncode == 0
+
+
+def ideal_makespan(edges, durations, max_parallel=None):
+    """
+    Lower bound on the makespan: the longest chain, or the total work spread over max_parallel slots.
+    """
+    finish = list()
+    for i, prereqs in enumerate(edges):
+        finish.append(max((finish[p] for p in prereqs), default=0.0) + durations[i])
+    ideal = max(finish, default=0.0)
+    if max_parallel:
+        ideal = max(ideal, sum(durations) / max_parallel)
+    return ideal
+
+
+def _percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run_benchmark(shape, n_tasks, sleep=0.0, max_parallel=None, seed=0, render=False, work_dir=None, workers=0):
+    """
+    Run one synthetic workflow and return its measurements as a dict.
+    With workers, the commands run on that many local worker processes through a RemoteExecutor.
+    """
+    rng = random.Random(seed)
+    edges = SHAPES[shape](n_tasks, rng)
+
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix="monitor_bench_")
+    script_path = os.path.join(work_dir, "exit_stamp.sh")
+    with open(script_path, 'w') as f:
+        f.write(EXIT_STAMP_SCRIPT)
+    os.chmod(script_path, 0o755)
+    stamp_dir = os.path.join(work_dir, "exit_stamps")
+    os.makedirs(stamp_dir, exist_ok=True)
+    stamp_paths = [os.path.join(stamp_dir, "{}.time".format(i)) for i in range(n_tasks)]
+    setup_start = time.time()
+    executor = None
+    worker_processes = list()
+    if workers:
+        # Started before the monitor runs, they wait on the executor's socket
+        executor = RemoteExecutor(os.path.join(work_dir, "workers.sock"))
+        worker_processes = spawn_local_workers(executor.address, workers)
+    monitor = Monitor("bench_{}_{}".format(shape, n_tasks), work_dir, max_parallel=max_parallel, executor=executor)
+    if not render:
+        # Still measures building the status output, only the writing goes nowhere
+        monitor.renderer = StatusRenderer(monitor, stream=open(os.devnull, 'w'))
+    for i, prereqs in enumerate(edges):
+        command = "{} {} {}".format(script_path, stamp_paths[i], sleep or 0)
+        task = Task(monitor, "task_{}".format(i), command, None, prereq_indexs=prereqs)
+        task.check_if_done_fn = functools.partial(_exited_ok, task)
+    setup_seconds = time.time() - setup_start
+
+    cpu_start = time.process_time()
+    run_start = time.time()
+    try:
+        statuses = monitor.run()
+    finally:
+        # The workers exit when the monitor closes the executor
+        for worker in worker_processes:
+            try:
+                worker.wait(RemoteExecutor.HEARTBEAT_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                worker.kill()
+                worker.wait()
+    makespan = time.time() - run_start
+    cpu_seconds = time.process_time() - cpu_start
+
+    # Latency from the last prerequisite's command exiting to the dependent launching, so including the time the
+    # monitor takes to notice the exit and judge the task done
+    exit_times = [_read_exit_time(path) for path in stamp_paths]
+    latencies = list()
+    for task in monitor.tasks:
+        prereq_exits = [exit_times[p] for p in task.prereq_indexs]
+        if prereq_exits and task.launched_time is not None and None not in prereq_exits:
+            latencies.append(task.launched_time - max(prereq_exits))
+
+    ideal = ideal_makespan(edges, [sleep] * n_tasks, max_parallel)
+    ticks = monitor.stats["ticks"]
+    return {
+        "shape": shape,
+        "tasks": n_tasks,
+        "sleep_seconds": sleep,
+        "max_parallel": max_parallel,
+        "workers": workers,
+        "failed": sum(1 for status in statuses.values() if status != Task.DONE),
+        "setup_seconds": setup_seconds,
+        "makespan_seconds": makespan,
+        "ideal_makespan_seconds": ideal,
+        "makespan_overhead_seconds": makespan - ideal,
+        "monitor_cpu_seconds": cpu_seconds,
+        "ticks": ticks,
+        "tick_cpu_seconds_total": monitor.stats["tick_cpu_seconds"],
+        "tick_cpu_seconds_mean": monitor.stats["tick_cpu_seconds"] / ticks if ticks else 0.0,
+        "tick_cpu_seconds_max": monitor.stats["max_tick_cpu_seconds"],
+        "log_writer_cpu_seconds": monitor.stats["log_writer_cpu_seconds"],
+        "launch_latency_seconds_mean": sum(latencies) / len(latencies) if latencies else 0.0,
+        "launch_latency_seconds_p50": _percentile(latencies, 0.5),
+        "launch_latency_seconds_p95": _percentile(latencies, 0.95),
+        "launch_latency_seconds_max": max(latencies, default=0.0),
+        "log_writes": monitor.stats["log_writes"],
+        "log_bytes_written": monitor.stats["log_bytes_written"],
+        "journal_bytes_read": monitor.stats["journal_bytes_read"],
+    }
+
+
+def main():
+
+    # Parse command line args.
+    cmdLineParser = argparse.ArgumentParser("Monitor Benchmark")
+    cmdLineParser.add_argument(
+        "--shapes",
+        nargs="+",
+        choices=sorted(SHAPES),
+        default=["chain", "fanout", "layered"],
+        help="DAG shapes to run")
+    cmdLineParser.add_argument(
+        "--sizes",
+        nargs="+",
+        type=int,
+        default=[10, 100, 1000],
+        help="Numbers of tasks to run, each with each shape")
+    cmdLineParser.add_argument(
+        "--sleep",
+        action="store",
+        type=float,
+        default=0.0,
+        help="Seconds each task sleeps, 0 runs a no-op command")
+    cmdLineParser.add_argument(
+        "--max-parallel",
+        action="store",
+        type=int,
+        dest="max_parallel",
+        default=None,
+        help="Monitor max_parallel, no limit by default")
+    cmdLineParser.add_argument(
+        "--seed",
+        action="store",
+        type=int,
+        default=0,
+        help="Seed for the random layered DAG")
+    cmdLineParser.add_argument(
+        "--workers",
+        action="store",
+        type=int,
+        default=0,
+        help="Run the tasks on this many local remote-worker processes instead of directly")
+    cmdLineParser.add_argument(
+        "--output",
+        action="store",
+        type=str,
+        default=None,
+        help="Write the results to this json file instead of stdout")
+    cmdLineParser.add_argument(
+        "--import-budget",
+        action="store",
+        type=float,
+        dest="import_budget",
+        default=IMPORT_BUDGET_SECONDS,
+        help="Fail if importing monitor_client takes longer than this many seconds")
+    args = cmdLineParser.parse_args()
+
+    results = list()
+    over_budget = False
+    failed_tasks = 0
+    for module in ("monitor_client", "monitor"):
+        seconds = import_seconds(module)
+        budget = args.import_budget if module == "monitor_client" else None
+        print("import {:16} {:8.4f}s{}".format(
+            module, seconds, "" if budget is None else " budget {:.4f}s".format(budget)), file=sys.stderr)
+        results.append({"module": module, "import_seconds": seconds, "import_budget_seconds": budget})
+        if budget is not None and seconds > budget:
+            over_budget = True
+
+    for n_tasks in args.sizes:
+        for shape in args.shapes:
+            result = run_benchmark(shape, n_tasks, args.sleep, args.max_parallel, args.seed, workers=args.workers)
+            print("{shape:8} {tasks:7} makespan {makespan_seconds:8.3f}s ideal {ideal_makespan_seconds:8.3f}s "
+                  "tick cpu {tick_cpu_seconds_mean:.5f}s writer cpu {log_writer_cpu_seconds:.3f}s "
+                  "launch latency p95 {launch_latency_seconds_p95:.4f}s".format(**result),
+                  file=sys.stderr)
+            results.append(result)
+            failed_tasks += result["failed"]
+
+    text = json.dumps(results, indent=4, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if over_budget:
+        sys.exit("monitor_client import time is over budget")
+    if failed_tasks:
+        sys.exit("{} benchmark tasks did not finish".format(failed_tasks))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+# PYTHON script
+
+"""
+Logging client for commands launched by a Monitor.
+
+Only what a task needs to report messages to its monitor, so that thousands of short tasks can import it cheaply:
+
+    import monitor_client
+    monitor_client.log_string("Meshed 1200 parts", "mesh")
+
+Nothing is imported up front beyond os, sys and time, everything else only when first needed. The daass package is
+only looked for (once) when a message has to go through the legacy json log path, which is when the launching monitor
+provided no journal.
+"""
+
+import os
+import sys
+import time
+
+# The environment variable names for the log paths, set by the monitor for the commands it launches
+LOG_DUMP = "MONITOR_LOG_DUMP_PATH"
+LOG_JSON = "MONITOR_LOG_JSON_PATH"
+LOG_JOURNAL = "MONITOR_LOG_JOURNAL_PATH"
+LOG_SOCKET = "MONITOR_LOG_SOCKET_PATH"
+
+# Larger messages than this go to the journal, a datagram is sent whole or not at all
+LOG_DATAGRAM_MAX = 60000
+# The kernel queues only a few datagrams, wait this long for room before using the journal instead
+LOG_SEND_TIMEOUT = 0.1
+
+DEBUG_TASK_KEY = "DEBUG"
+
+# Logging dict keys
+KEY_LOG = "info_log"
+KEY_MESSAGE = "message"
+KEY_TIMESTAMP = "timestamp"
+KEY_TASK = "task"
+
+TIMESTAMP_FORMAT = '%m/%d %H:%M:%S'
+
+_socket_client = None
+# start path -> directory holding the daass package above it, or None
+_daass_parent_paths = dict()
+
+
+def daass_parent_path(start_path=None):
+    """
+    Return the directory holding the daass package that start_path (this file by default) is in, or None if it is
+    not inside one. Searched for once per start path, the result is cached.
+    """
+    start_path = os.path.abspath(start_path or __file__)
+    if start_path not in _daass_parent_paths:
+        parent_path = None
+        path = os.path.dirname(start_path)
+        while True:
+            if os.path.basename(path) == "daass":
+                parent_path = os.path.dirname(path)
+                break
+            parent = os.path.dirname(path)
+            if parent == path:
+                # Reached the root
+                break
+            path = parent
+        _daass_parent_paths[start_path] = parent_path
+    return _daass_parent_paths[start_path]
+
+
+def import_file_utils(start_path=None):
+    """
+    Import daass.shared.file_utils, making the daass package importable first if needed, as when launched as a
+    standalone script from start_path. Raises ImportError if there is no daass package to be found.
+    """
+    try:
+        from daass.shared import file_utils
+    except ImportError:
+        parent_path = daass_parent_path(start_path)
+        if parent_path is None:
+            raise ImportError("daass package not found above " + os.path.abspath(start_path or __file__))
+        if parent_path not in sys.path:
+            sys.path.append(parent_path)
+        from daass.shared import file_utils
+    return file_utils
+
+
+def send_log_datagram(socket_path, record):
+    """
+    Send one json record to the monitor's log socket, waiting at most LOG_SEND_TIMEOUT.
+    Returns False if it was not sent (no monitor listening, its queue is full, or the record is too large).
+    """
+    global _socket_client
+    import json
+    import socket
+
+    data = json.dumps(record).encode("utf-8")
+    if len(data) > LOG_DATAGRAM_MAX:
+        return False
+    if _socket_client is None:
+        _socket_client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        _socket_client.settimeout(LOG_SEND_TIMEOUT)
+    try:
+        _socket_client.sendto(data, socket_path)
+    except OSError:
+        return False
+    return True
+
+
+def journal_append(journal_path, record):
+    """
+    Append one json record as a single line to the journal.
+    This costs the same no matter how much has already been logged.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        # Not available on windows, journal appends are then unlocked
+        fcntl = None
+    import json
+
+    line = (json.dumps(record) + "\n").encode("utf-8")
+    fd = os.open(journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        if fcntl:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        os.write(fd, line)
+    finally:
+        # Closing the descriptor also releases the lock
+        os.close(fd)
+
+
+def _rewrite_json_log(json_path, message, task_key):
+    # Launched by a monitor without a journal, rewrite the json log directly
+    file_utils = import_file_utils()
+    logs_json_fie, logs_json_dict = file_utils.checkout_json_file(json_path)
+    entry = {
+        KEY_MESSAGE: message,
+        KEY_TIMESTAMP: time.strftime(TIMESTAMP_FORMAT),
+    }
+    try:
+        if task_key in logs_json_dict:
+            logs_json_dict[task_key][KEY_LOG].append(entry)
+            file_utils.save_json_file(logs_json_fie, logs_json_dict)
+        elif task_key == DEBUG_TASK_KEY:
+            logs_json_dict[task_key] = {KEY_LOG: [entry]}
+            file_utils.save_json_file(logs_json_fie, logs_json_dict)
+    finally:
+        file_utils.release_file(logs_json_fie)
+
+
+def log_string(message, task_key=None):
+    """
+    This writes a message to the monitor log of the task. The log is found through the environment variables set
+    by the monitor that launched this process. Outside of a monitor, or without a task key, the message is printed.
+    """
+    try:
+        if os.environ.get(LOG_JOURNAL) and task_key:
+            record = {
+                KEY_TASK: task_key,
+                KEY_MESSAGE: message,
+                KEY_TIMESTAMP: time.strftime(TIMESTAMP_FORMAT),
+            }
+            # Straight to the running monitor if it is listening, otherwise through the journal
+            if not (os.environ.get(LOG_SOCKET) and send_log_datagram(os.environ[LOG_SOCKET], record)):
+                # The monitor reads the journal later than the socket, so once a message has gone through the journal
+                # all later ones must too, or they could be applied before it. Dropping the socket from the environment
+                # also keeps to the journal the processes started from here on.
+                os.environ.pop(LOG_SOCKET, None)
+                journal_append(os.environ[LOG_JOURNAL], record)
+
+        elif os.environ.get(LOG_JSON) and task_key:
+            _rewrite_json_log(os.environ[LOG_JSON], message, task_key)
+
+        else:
+            print(message)
+    except:
+        print(message)